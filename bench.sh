@@ -0,0 +1,13 @@
+#!/bin/bash
+
+# Runs the keeper against an in-process mock node; no testchain is needed.
+# Arguments are passed on, e.g. ./bench.sh --urns 10000 --auctions 500 --latency 20 --rpc-batch-size 50
+# ./bench.sh startup [--runs 5] times cold starts up to the first End.live() check instead.
+
+BENCHMARK=benchmarks.cage_keeper_benchmark
+if [ "$1" == "startup" ]; then
+    BENCHMARK=benchmarks.startup_benchmark
+    shift
+fi
+
+PYTHONPATH=$PYTHONPATH:.:./lib/pymaker:./lib/auction-keeper:./lib/pygasprice-client python3 -m $BENCHMARK $@
@@ -0,0 +1,134 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import logging
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from web3 import Web3
+
+from benchmarks.mock_rpc import MockRpcProvider, SyntheticDss
+from src.cage_keeper import CageKeeper
+
+
+class Benchmark:
+    """Runs each phase of a `CageKeeper` against a `MockRpcProvider`, recording wall time, RPC calls and peak memory"""
+
+    def __init__(self, provider: MockRpcProvider, trace_memory: bool = True):
+        self.provider = provider
+        self.trace_memory = trace_memory
+        self.results = []
+
+    @contextmanager
+    def phase(self, name: str):
+        self.provider.reset_counters()
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            peak = 0
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.results.append({"phase": name, "seconds": seconds, "roundTrips": self.provider.round_trips,
+                                 "calls": dict(self.provider.calls), "peakBytes": peak})
+
+    def report(self) -> str:
+        lines = [f"{'phase':<12} {'wall (s)':>10} {'round trips':>12} {'calls':>8} {'peak (MiB)':>11}  calls by method"]
+        for result in self.results:
+            methods = ", ".join(f"{method}={count}" for method, count in
+                                sorted(result["calls"].items(), key=lambda item: -item[1]))
+            lines.append(f"{result['phase']:<12} {result['seconds']:>10.3f} {result['roundTrips']:>12} "
+                         f"{sum(result['calls'].values()):>8} {result['peakBytes'] / 2**20:>11.1f}  {methods}")
+        return "\n".join(lines)
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("cage-keeper-benchmark")
+
+    parser.add_argument("--urns", type=int, default=1000,
+                        help="Number of synthetic urns, spread across all ilks (default: 1000)")
+    parser.add_argument("--auctions", type=int, default=100,
+                        help="Number of auctions kicked by each flip, flap and flop contract (default: 100)")
+    parser.add_argument("--underwater-every", type=int, default=10,
+                        help="Make every Nth urn under-collateralized (default: 10)")
+    parser.add_argument("--blocks", type=int, default=100000,
+                        help="Number of blocks the frob history is spread across (default: 100000)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay added to every JSON-RPC request, in milliseconds (default: 0)")
+    parser.add_argument("--no-memory", dest='trace_memory', action='store_false',
+                        help="Do not trace peak memory, which slows Python down noticeably")
+    parser.add_argument("--json", type=str,
+                        help="Also write the results as JSON to this file (e.g. /path/to/results.json)")
+    parser.add_argument("--debug", dest='debug', action='store_true',
+                        help="Show keeper log output")
+
+    # Any other argument is passed on to the keeper, e.g. --rpc-batch-size or --urn-history-workers
+    arguments, keeper_args = parser.parse_known_args(args)
+
+    provider = MockRpcProvider(latency=arguments.latency / 1000)
+    benchmark = Benchmark(provider, arguments.trace_memory)
+
+    with benchmark.phase("startup"):
+        keeper = CageKeeper(args=["--network", "testnet", "--eth-from", provider.from_address] + keeper_args,
+                            web3=Web3(provider))
+
+    logging.getLogger('cage-keeper').setLevel(logging.DEBUG if arguments.debug else logging.WARNING)
+
+    ilk_names = [collateral.ilk.name for collateral in keeper.dss.collaterals.values()]
+    dss = SyntheticDss(ilk_names, arguments.urns, arguments.auctions, arguments.underwater_every, arguments.blocks)
+    provider.attach(keeper.dss, dss)
+
+    with benchmark.phase("ilks"):
+        ilks = keeper.get_ilks()
+
+    with benchmark.phase("auctions"):
+        keeper.all_active_auctions()
+
+    with benchmark.phase("urns"):
+        urns = keeper.get_underwater_urns(ilks)
+
+    # Auctions are tracked between scans, so start facilitation from a cold keeper as a freshly started one would
+    keeper.active_auctions = {}
+
+    with benchmark.phase("facilitate"):
+        keeper.facilitate_processing_period()
+    transactions = provider.nonce
+
+    with benchmark.phase("thaw"):
+        keeper.thaw_cage()
+
+    print(f"{arguments.urns} urns across {len(ilk_names)} ilks, {arguments.auctions} auctions per contract, "
+          f"{arguments.latency}ms latency; found {len(urns)}/{dss.underwater()} underwater urns, "
+          f"sent {transactions} facilitation transactions, {keeper.errors} errors")
+    print(benchmark.report())
+
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump({"urns": arguments.urns, "auctions": arguments.auctions, "latencyMs": arguments.latency,
+                       "keeperArgs": keeper_args, "phases": benchmark.results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,378 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from eth_abi import encode_abi
+from eth_utils import to_checksum_address
+from web3 import Web3
+from web3.providers.base import BaseProvider
+
+RAY = 10**27
+WAD = 10**18
+
+
+def selector(signature: str) -> str:
+    return Web3.keccak(text=signature)[:4].hex()
+
+
+def to_bytes32(text: str) -> bytes:
+    return text.encode('utf-8').ljust(32, b'\x00')
+
+
+def synthetic_address(prefix: int, index: int) -> str:
+    return to_checksum_address(prefix.to_bytes(4, 'big') + index.to_bytes(16, 'big'))
+
+
+FROB = selector("frob(bytes32,address,address,address,int256,int256)")
+ILKS = selector("ilks(bytes32)")
+URNS = selector("urns(bytes32,address)")
+KICKS = selector("kicks()")
+BIDS = selector("bids(uint256)")
+LIVE = selector("live()")
+WHEN = selector("when()")
+
+# Answer to reads the backend knows nothing about; decodes as zero for any static return type
+ZEROS = '0x' + '00' * 32 * 8
+
+
+class SyntheticDss:
+    """Vault and auction state of a synthetic deployment.
+
+    `urns` urns are spread evenly across `ilk_names`, and every `underwater_every`th of them is under-collateralized.
+    Every auction contract has kicked `auctions` auctions, three in four of which are still active.
+    Each urn was frobbed once, in a block spread evenly across the first `blocks` blocks.
+    """
+
+    RATE = RAY
+    SPOT = RAY
+    MAT = 3 * RAY // 2
+    ART = 1000 * WAD
+
+    def __init__(self, ilk_names: List[str], urns: int, auctions: int, underwater_every: int = 10,
+                 blocks: int = 100000):
+        assert len(ilk_names) > 0
+        assert urns >= 0
+        assert auctions >= 0
+        assert underwater_every > 0
+        assert blocks > 0
+
+        self.ilk_names = list(ilk_names)
+        self.auctions = auctions
+        self.blocks = blocks
+
+        # ilk name -> urn address -> (ink, art)
+        self.urns: Dict[str, Dict[str, tuple]] = {name: {} for name in self.ilk_names}
+        self.frobs = []
+        for index in range(urns):
+            name = self.ilk_names[index % len(self.ilk_names)]
+            address = synthetic_address(0x0bad0000, index)
+            ink = self.ART // 2 if index % underwater_every == 0 else self.ART
+            self.urns[name][address.lower()] = (ink, self.ART)
+            self.frobs.append((1 + index * blocks // max(urns, 1), name, address, ink, self.ART))
+
+    def underwater(self) -> int:
+        return sum(1 for urns in self.urns.values() for ink, art in urns.values()
+                   if art * self.RATE > ink * self.SPOT * self.MAT // RAY)
+
+    def ilk(self, name: str) -> tuple:
+        """ `Vat.ilks`: Art, rate, spot, line, dust """
+        if name not in self.urns:
+            return 0, 0, 0, 0, 0
+        art = sum(art for ink, art in self.urns[name].values())
+        return art, self.RATE, self.SPOT, 10**9 * RAY * WAD, 0
+
+    def urn(self, name: str, address: str) -> tuple:
+        return self.urns.get(name, {}).get(address.lower(), (0, 0))
+
+    def bid(self, id: int, flip: bool) -> tuple:
+        guy = synthetic_address(0x0b1d0000, id) if 0 < id <= self.auctions and id % 4 != 0 else '0x' + '00' * 20
+        if flip:
+            return 10 * RAY * WAD, WAD, guy, 0, 2**40, guy, guy, 20 * RAY * WAD
+        return WAD, 10 * RAY * WAD, guy, 0, 2**40
+
+
+class MockRpcProvider(BaseProvider):
+    """In-process stand-in for an Ethereum node, adding `latency` seconds of delay to every request.
+
+    Until a `SyntheticDss` is attached every contract read returns zeros, which is enough for pymaker to build a
+    `DssDeployment`. Calls are then routed by the contract roles registered with `attach`, so `Vat.ilks` and `Spotter.ilks` (which share a selector)
+    are told apart. Transactions are mined instantly, one per block, and always succeed. `calls` counts every
+    JSON-RPC method served and `round_trips` every request made, a batch counting once.
+    """
+
+    def __init__(self, latency: float = 0.0, from_address: Optional[str] = None):
+        assert latency >= 0
+
+        self.dss = None
+        self.latency = latency
+        self.from_address = from_address or synthetic_address(0x0ee00000, 0)
+        self.roles = {}
+        self.lock = threading.Lock()
+        self.calls = Counter()
+        self.round_trips = 0
+        self.head = 1
+        self.nonce = 0
+        self.receipts = {}
+
+        # Frob LogNotes, laid out exactly as the Vat's `note` modifier emits them
+        self.logs = []
+        self.log_blocks = []
+
+    def attach(self, deployment, dss: SyntheticDss):
+        """ Serves `dss` from the contracts of a pymaker `DssDeployment` built on this provider """
+        assert isinstance(dss, SyntheticDss)
+
+        roles = {deployment.vat.address.address.lower(): ('vat', None),
+                 deployment.spotter.address.address.lower(): ('spotter', None),
+                 deployment.end.address.address.lower(): ('end', None),
+                 deployment.flapper.address.address.lower(): ('flap', None),
+                 deployment.flopper.address.address.lower(): ('flop', None)}
+        for collateral in deployment.collaterals.values():
+            if collateral.flipper is not None:
+                roles[collateral.flipper.address.address.lower()] = ('flip', collateral.ilk.name)
+
+        self.dss = dss
+        self.roles = roles
+        self.head = max(self.head, dss.blocks)
+
+        vat = deployment.vat.address.address
+        self.logs = [self._frob_log(vat, index, *frob) for index, frob in enumerate(self.dss.frobs)]
+        self.log_blocks = [frob[0] for frob in self.dss.frobs]
+
+    def reset_counters(self):
+        with self.lock:
+            self.calls = Counter()
+            self.round_trips = 0
+
+    def isConnected(self) -> bool:
+        return True
+
+    def make_request(self, method, params) -> dict:
+        self._delay()
+        with self.lock:
+            self.round_trips += 1
+        return self._respond({"jsonrpc": "2.0", "id": 0, "method": method, "params": params})
+
+    def make_batch_request(self, payload: List[dict]) -> List[dict]:
+        """ Serves a JSON-RPC batch in a single round trip """
+        self._delay()
+        with self.lock:
+            self.round_trips += 1
+        return [self._respond(item) for item in payload]
+
+    def _delay(self):
+        # Sleeping outside of the lock lets concurrent requests overlap, as they would against a real node
+        if self.latency > 0:
+            time.sleep(self.latency)
+
+    def _respond(self, request: dict) -> dict:
+        method, params = request['method'], request['params']
+        with self.lock:
+            self.calls[method] += 1
+            handler = getattr(self, f"_{method}", None)
+            if handler is None:
+                return {"jsonrpc": "2.0", "id": request['id'],
+                        "error": {"code": -32601, "message": f"Method {method} not supported by mock"}}
+            return {"jsonrpc": "2.0", "id": request['id'], "result": handler(*params)}
+
+    # Node
+
+    def _web3_clientVersion(self):
+        return "MockRpc/v1.0"
+
+    def _net_version(self):
+        return "1337"
+
+    def _eth_chainId(self):
+        return hex(1337)
+
+    def _eth_syncing(self):
+        return False
+
+    def _eth_accounts(self):
+        return [self.from_address]
+
+    def _eth_blockNumber(self):
+        return hex(self.head)
+
+    def _eth_gasPrice(self):
+        return hex(10**9)
+
+    def _eth_getBalance(self, address, block='latest'):
+        return hex(1000 * WAD)
+
+    def _eth_getCode(self, address, block='latest'):
+        return '0x6080'
+
+    def _eth_getBlockByNumber(self, block, full_transactions=False):
+        number = self._block_number(block)
+        return {"number": hex(number), "hash": self._hash(number, 0xb10c), "parentHash": self._hash(number - 1, 0xb10c),
+                "timestamp": hex(1600000000 + 13 * number), "gasLimit": hex(12500000), "gasUsed": "0x0",
+                "miner": '0x' + '00' * 20, "difficulty": "0x1", "totalDifficulty": hex(number),
+                "extraData": "0x", "nonce": '0x' + '00' * 8, "sha3Uncles": self._hash(0, 0), "size": "0x0",
+                "logsBloom": '0x' + '00' * 256, "transactionsRoot": self._hash(0, 0),
+                "stateRoot": self._hash(0, 0), "receiptsRoot": self._hash(0, 0), "transactions": [], "uncles": []}
+
+    # Filters
+
+    def _eth_newFilter(self, params):
+        return "0x1"
+
+    def _eth_newBlockFilter(self):
+        return "0x2"
+
+    def _eth_getFilterChanges(self, filter_id):
+        return []
+
+    def _eth_getFilterLogs(self, filter_id):
+        return []
+
+    def _eth_uninstallFilter(self, filter_id):
+        return True
+
+    def _eth_getLogs(self, params):
+        from_block = self._block_number(params.get('fromBlock', 'earliest'))
+        to_block = self._block_number(params.get('toBlock', 'latest'))
+        addresses = params.get('address')
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = None if addresses is None else [address.lower() for address in addresses]
+
+        start = bisect.bisect_left(self.log_blocks, from_block)
+        end = bisect.bisect_right(self.log_blocks, to_block)
+        return [log for log in self.logs[start:end]
+                if (addresses is None or log['address'].lower() in addresses)
+                and self._topics_match(params.get('topics') or [], log['topics'])]
+
+    # Calls and transactions
+
+    def _eth_call(self, transaction, block='latest'):
+        to = transaction.get('to', '').lower()
+        data = transaction.get('data', '0x')
+        role, ilk_name = self.roles.get(to, (None, None))
+        method, args = data[:10], bytes.fromhex(data[10:])
+
+        if role == 'vat' and method == ILKS:
+            return self._encode(['uint256'] * 5, self.dss.ilk(self._name(args[0:32])))
+        elif role == 'vat' and method == URNS:
+            return self._encode(['uint256'] * 2, self.dss.urn(self._name(args[0:32]), '0x' + args[44:64].hex()))
+        elif role == 'spotter' and method == ILKS:
+            return self._encode(['address', 'uint256'], ('0x' + '00' * 20, self.dss.MAT))
+        elif role == 'end' and method == LIVE:
+            return self._encode(['uint256'], (0,))
+        elif role == 'end' and method == WHEN:
+            return self._encode(['uint256'], (1600000000,))
+        elif role in ['flip', 'flap', 'flop'] and method == KICKS:
+            return self._encode(['uint256'], (self.dss.auctions,))
+        elif role == 'flip' and method == BIDS:
+            return self._encode(['uint256', 'uint256', 'address', 'uint48', 'uint48', 'address', 'address', 'uint256'],
+                                self.dss.bid(int.from_bytes(args[0:32], 'big'), flip=True))
+        elif role in ['flap', 'flop'] and method == BIDS:
+            return self._encode(['uint256', 'uint256', 'address', 'uint48', 'uint48'],
+                                self.dss.bid(int.from_bytes(args[0:32], 'big'), flip=False))
+        elif block == 'pending':
+            # A transaction being simulated ahead of sending it, e.g. End.skim, which always succeeds
+            return '0x'
+
+        return ZEROS
+
+    def _eth_estimateGas(self, transaction, block=None):
+        return hex(100000)
+
+    def _eth_getTransactionCount(self, address, block='latest'):
+        return hex(self.nonce)
+
+    def _parity_nextNonce(self, address):
+        return hex(self.nonce)
+
+    def _eth_sendTransaction(self, transaction):
+        return self._mine(transaction)
+
+    def _eth_sendRawTransaction(self, raw_transaction):
+        return self._mine({"from": self.from_address, "to": None})
+
+    def _eth_getTransactionByHash(self, tx_hash):
+        receipt = self.receipts.get(tx_hash)
+        if receipt is None:
+            return None
+        return {"hash": tx_hash, "nonce": receipt['nonce'], "blockHash": receipt['blockHash'],
+                "blockNumber": receipt['blockNumber'], "transactionIndex": "0x0", "from": receipt['from'],
+                "to": receipt['to'], "value": "0x0", "gas": hex(100000), "gasPrice": hex(10**9), "input": "0x",
+                "v": "0x1b", "r": "0x1", "s": "0x1"}
+
+    def _eth_getTransactionReceipt(self, tx_hash):
+        receipt = self.receipts.get(tx_hash)
+        return None if receipt is None else {key: value for key, value in receipt.items() if key != 'nonce'}
+
+    def _mine(self, transaction: dict) -> str:
+        self.head += 1
+        self.nonce += 1
+        tx_hash = self._hash(self.nonce, 0x7c)
+        self.receipts[tx_hash] = {"transactionHash": tx_hash, "transactionIndex": "0x0", "nonce": hex(self.nonce - 1),
+                                  "blockHash": self._hash(self.head, 0xb10c), "blockNumber": hex(self.head),
+                                  "from": transaction.get('from', self.from_address), "to": transaction.get('to'),
+                                  "cumulativeGasUsed": hex(100000), "gasUsed": hex(100000), "contractAddress": None,
+                                  "logs": [], "logsBloom": '0x' + '00' * 256, "status": "0x1"}
+        return tx_hash
+
+    # Helpers
+
+    def _block_number(self, block) -> int:
+        if block in ['latest', 'pending', None]:
+            return self.head
+        elif block == 'earliest':
+            return 0
+        elif isinstance(block, int):
+            return block
+        return int(block, 16)
+
+    @staticmethod
+    def _topics_match(wanted: list, topics: list) -> bool:
+        for index, topic in enumerate(wanted):
+            if topic is None:
+                continue
+            options = topic if isinstance(topic, list) else [topic]
+            if index >= len(topics) or topics[index].lower() not in [option.lower() for option in options]:
+                return False
+        return True
+
+    @staticmethod
+    def _encode(types: list, values: tuple) -> str:
+        return '0x' + encode_abi(types, list(values)).hex()
+
+    @staticmethod
+    def _name(raw: bytes) -> str:
+        return raw.rstrip(b'\x00').decode('utf-8')
+
+    @staticmethod
+    def _hash(number: int, salt: int) -> str:
+        return '0x' + salt.to_bytes(4, 'big').hex() + max(number, 0).to_bytes(28, 'big').hex()
+
+    def _frob_log(self, vat: str, index: int, block: int, ilk_name: str, urn: str, ink: int, art: int) -> dict:
+        ilk, address = to_bytes32(ilk_name), bytes.fromhex(urn[2:]).rjust(32, b'\x00')
+        calldata = bytes.fromhex(FROB[2:]) + ilk + address * 3 + ink.to_bytes(32, 'big') + art.to_bytes(32, 'big')
+        data = encode_abi(['bytes'], [calldata.ljust(224, b'\x00')])
+        return {"address": vat, "blockNumber": hex(block), "blockHash": self._hash(block, 0xb10c),
+                "transactionHash": self._hash(index, 0xf70b), "transactionIndex": "0x0", "logIndex": hex(index),
+                "removed": False, "data": '0x' + data.hex(),
+                "topics": ['0x' + bytes.fromhex(FROB[2:]).ljust(32, b'\x00').hex(), '0x' + ilk.hex(),
+                           '0x' + address.hex(), '0x' + address.hex()]}
@@ -0,0 +1,95 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+STEPS = ["import", "construct", "firstLive", "loadDeployment"]
+
+
+def measure(latency: float, keeper_args: list) -> dict:
+    """ Times, in this process, each step from a cold interpreter to the first `End.live()` check """
+    start = time.perf_counter()
+    from web3 import Web3
+    from benchmarks.mock_rpc import MockRpcProvider
+    from src.cage_keeper import CageKeeper
+    imported = time.perf_counter()
+
+    provider = MockRpcProvider(latency=latency)
+    keeper = CageKeeper(args=["--network", "testnet", "--eth-from", provider.from_address] + keeper_args,
+                        web3=Web3(provider))
+    constructed = time.perf_counter()
+
+    keeper.cage_watcher.live()
+    first_live = time.perf_counter()
+    deployment_imported = 'pymaker.deployment' in sys.modules
+
+    # What a keeper building the whole deployment up front would also have paid before its first check
+    keeper.dss
+    loaded = time.perf_counter()
+
+    return {"import": imported - start, "construct": constructed - imported, "firstLive": first_live - constructed,
+            "loadDeployment": loaded - first_live, "deploymentImported": deployment_imported}
+
+
+def main(args: list):
+    parser = argparse.ArgumentParser("cage-keeper-startup-benchmark")
+
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Number of fresh interpreters to time startup in (default: 5)")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="Delay added to every JSON-RPC request, in milliseconds (default: 0)")
+    parser.add_argument("--json", type=str,
+                        help="Also write the results as JSON to this file (e.g. /path/to/results.json)")
+    parser.add_argument("--child", action='store_true', help=argparse.SUPPRESS)
+
+    # Any other argument is passed on to the keeper, e.g. --fast-start
+    arguments, keeper_args = parser.parse_known_args(args)
+
+    if arguments.child:
+        print(json.dumps(measure(arguments.latency / 1000, keeper_args)))
+        return
+
+    runs = []
+    for _ in range(arguments.runs):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.startup_benchmark", "--child",
+                                 "--latency", str(arguments.latency)] + keeper_args,
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+
+    print(f"{arguments.runs} cold starts, {arguments.latency}ms latency")
+    print(f"{'step':<16} {'median (s)':>10} {'min (s)':>10} {'max (s)':>10}")
+    for step in STEPS:
+        values = [run[step] for run in runs]
+        print(f"{step:<16} {statistics.median(values):>10.3f} {min(values):>10.3f} {max(values):>10.3f}")
+    first_live = [run["import"] + run["construct"] + run["firstLive"] for run in runs]
+    print(f"{'to first live()':<16} {statistics.median(first_live):>10.3f} {min(first_live):>10.3f} "
+          f"{max(first_live):>10.3f}")
+    imported = sum(run["deploymentImported"] for run in runs)
+    print(f"pymaker.deployment imported before the first live(): {imported}/{arguments.runs} runs")
+
+    if arguments.json:
+        with open(arguments.json, "w") as file:
+            json.dump({"latencyMs": arguments.latency, "keeperArgs": keeper_args, "runs": runs}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
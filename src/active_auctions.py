@@ -0,0 +1,88 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from typing import List, Optional
+
+from pymaker import Address
+
+from src.auction_index import AuctionIndex
+from src.batch import BatchCaller
+from src.log_scanner import LogScanner
+
+
+class ActiveAuctions:
+    """Incrementally tracks the auctions of one flipper, flapper or flopper which can be skipped or yanked.
+
+    Auctions which are dealt or yanked never become active again, so each refresh only re-reads the auctions
+    which were active last time plus those kicked since.
+
+    With an `AuctionIndex`, ids come from Kick, deal and yank logs instead, so only auctions still open are read,
+    however many were ever kicked.
+    """
+
+    def __init__(self, auction, batch: BatchCaller, index: Optional[AuctionIndex] = None,
+                 scanner: Optional[LogScanner] = None, from_block: int = 0):
+        assert isinstance(batch, BatchCaller)
+        assert isinstance(index, AuctionIndex) or index is None
+        assert isinstance(scanner, LogScanner) or index is None
+
+        self.auction = auction
+        self.batch = batch
+        self.index = index
+        self.scanner = scanner
+        self.from_block = from_block
+        self.lock = threading.Lock()
+        self.last_kick = 0
+        self.active = {}
+
+    def refresh(self) -> List:
+        if self.index:
+            return self.refresh_indexed()
+
+        with self.lock:
+            kicks = self.auction.kicks()
+            ids = sorted(set(self.active.keys()) | set(range(self.last_kick + 1, kicks + 1)))
+
+            self.active = {bid.id: bid for bid in self.batch.bids(self.auction, ids) if self.is_active(bid)}
+            self.last_kick = kicks
+
+            return list(self.active.values())
+
+    def refresh_indexed(self) -> List:
+        with self.lock:
+            block = self.index.sync(self.scanner, self.auction, self.from_block)
+            contract = self.auction.address.address
+            bids = self.batch.bids(self.auction, self.index.open_ids(contract))
+
+            self.active = {bid.id: bid for bid in bids if self.is_active(bid)}
+            # Auctions closed by a transaction the logs did not cover yet, or in a phase which cannot be skipped
+            self.index.record(contract, [], [bid.id for bid in bids if bid.id not in self.active], block)
+
+            return list(self.active.values())
+
+    def is_active(self, bid) -> bool:
+        """ Returns whether the auction meets the requirements to be called by End.skip, Flap.yank, or Flop.yank """
+        if bid.guy == Address("0x0000000000000000000000000000000000000000"):
+            return False
+
+        # flip auctions are only skipped while in the tend phase
+        from pymaker.auctions import Flipper
+        if isinstance(self.auction, Flipper):
+            return bid.bid < bid.tab
+
+        return True
@@ -0,0 +1,103 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import sqlite3
+import threading
+from typing import List, Optional
+
+from eth_utils import event_abi_to_log_topic
+from hexbytes import HexBytes
+from web3 import Web3
+
+from src.log_scanner import LogScanner
+
+# dss auction contracts record deal and yank through LibNote, whose first topic is the selector, left-aligned
+DEAL_TOPIC = '0x' + Web3.keccak(text="deal(uint256)")[:4].hex()[2:].ljust(64, '0')
+YANK_TOPIC = '0x' + Web3.keccak(text="yank(uint256)")[:4].hex()[2:].ljust(64, '0')
+
+
+class AuctionIndex:
+    """SQLite file recording, per auction contract, every auction kicked, whether it has since been closed by a deal
+    or a yank, and the last block synced"""
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, path: str):
+        assert isinstance(path, str)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS auctions (contract TEXT NOT NULL, id INTEGER NOT NULL, "
+                            "open INTEGER NOT NULL, PRIMARY KEY (contract, id))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS synced (contract TEXT PRIMARY KEY, block INTEGER NOT NULL)")
+
+    def last_block(self, contract: str) -> Optional[int]:
+        with self.lock:
+            row = self.db.execute("SELECT block FROM synced WHERE contract = ?", (contract,)).fetchone()
+        return row[0] if row else None
+
+    def record(self, contract: str, kicked: List[int], closed: List[int], block: int):
+        """ Records kicked and closed auction ids and advances the synced block in a single transaction.
+
+        A kick never reopens an auction already known to be closed, so windows may safely be read again.
+        """
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO auctions (contract, id, open) VALUES (?, ?, 1)",
+                                [(contract, id) for id in kicked])
+            self.db.executemany("INSERT OR REPLACE INTO auctions (contract, id, open) VALUES (?, ?, 0)",
+                                [(contract, id) for id in closed])
+            self.db.execute("INSERT OR REPLACE INTO synced (contract, block) VALUES (?, ?)", (contract, block))
+
+    def open_ids(self, contract: str) -> List[int]:
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM auctions WHERE contract = ? AND open = 1 ORDER BY id",
+                                   (contract,)).fetchall()
+        return [row[0] for row in rows]
+
+    def sync(self, scanner: LogScanner, auction, from_block: int, lookback: int = 12) -> int:
+        """ Records Kick, deal and yank logs of `auction` up to the current block, committing after each range.
+
+        Each sync re-reads `lookback` blocks below the last synced block, as `IndexedUrnHistoryProvider` does.
+        """
+        contract = auction.address.address
+        last_block = self.last_block(contract)
+        start = from_block if last_block is None else max(from_block, last_block - lookback)
+        to_block = scanner.head()
+
+        kick_abi = next(abi for abi in auction.abi if abi.get('type') == 'event' and abi.get('name') == 'Kick')
+        kick_topic = '0x' + event_abi_to_log_topic(kick_abi).hex()
+        filter_params = {'address': contract, 'topics': [[kick_topic, DEAL_TOPIC, YANK_TOPIC]]}
+
+        for window_start, window_end, logs in scanner.scan(filter_params, start, to_block):
+            kicked, closed = [], []
+            for log in logs:
+                topic = HexBytes(log['topics'][0]).hex()
+                if topic == kick_topic:
+                    # The id is the first field of every Kick event, and is not indexed
+                    kicked.append(int.from_bytes(HexBytes(log['data'])[0:32], 'big'))
+                else:
+                    closed.append(int.from_bytes(HexBytes(log['topics'][2]), 'big'))
+
+            self.record(contract, kicked, closed, window_end)
+            self.logger.debug(f"Indexed {len(kicked)} kicks and {len(closed)} deals/yanks of {contract} "
+                              f"from blocks {window_start}-{window_end}")
+
+        return to_block
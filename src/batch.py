@@ -0,0 +1,183 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import json
+import logging
+import time
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+from hexbytes import HexBytes
+from web3 import Web3, HTTPProvider
+from web3._utils.request import make_post_request
+
+from pymaker import Address, Transact
+from pymaker.numeric import Wad, Rad
+
+from src.metrics import Metrics
+
+
+class BatchCaller:
+    """Sends read-only JSON-RPC requests in batches of `batch_size`, one HTTP round trip per batch.
+
+    Providers which are not plain HTTP (e.g. IPC or test providers) are served one request at a time unless they
+    implement `make_batch_request`, so callers never need to care which transport is in use.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, web3: Web3, batch_size: int = 100, metrics: Optional[Metrics] = None):
+        assert isinstance(web3, Web3)
+        assert isinstance(batch_size, int)
+        assert batch_size > 0
+        assert isinstance(metrics, Metrics) or metrics is None
+
+        self.web3 = web3
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self._ids = itertools.count(1)
+
+    def request(self, requests: List[Tuple[str, list]]) -> List[dict]:
+        """ Sends `(method, params)` requests and returns raw JSON-RPC responses in the same order """
+        responses = []
+        for start in range(0, len(requests), self.batch_size):
+            payload = [{"jsonrpc": "2.0", "method": method, "params": params, "id": next(self._ids)}
+                       for method, params in requests[start:start + self.batch_size]]
+            responses.extend(self._send(payload))
+
+        return responses
+
+    def call(self, calls: List[Tuple[Address, str]], block_identifier='latest') -> List[HexBytes]:
+        """ Executes `eth_call` for each `(address, calldata)` pair, raising if any of them fails """
+        requests = [("eth_call", [{"to": address.address, "data": data}, block_identifier]) for address, data in calls]
+
+        results = []
+        for response in self.request(requests):
+            if 'error' in response:
+                raise ValueError(response['error'])
+            results.append(HexBytes(response['result']))
+
+        return results
+
+    def read(self, calls: List[Tuple[Any, str, list]]) -> List[tuple]:
+        """ Calls a view function for each `(pymaker contract, function name, args)` and returns the decoded outputs """
+        encoded = [(contract.address, contract._contract.encodeABI(fn_name=name, args=args))
+                   for contract, name, args in calls]
+
+        results = []
+        for (contract, name, _), data in zip(calls, self.call(encoded)):
+            outputs = contract._contract.get_function_by_name(name).abi['outputs']
+            results.append(self.web3.codec.decode_abi([output['type'] for output in outputs], data))
+
+        return results
+
+    def estimate_gas(self, transactions: List[Transact], from_address: Address) -> List[Optional[int]]:
+        """ Returns `eth_estimateGas` for each transaction, or None for those which could not be estimated """
+        requests = [("eth_estimateGas", [{"from": from_address.address, "to": transact.address.address,
+                                          "data": calldata(transact)}]) for transact in transactions]
+
+        return [None if 'error' in response else int(response['result'], 16) for response in self.request(requests)]
+
+    def simulate(self, transactions: List[Transact], from_address: Address) -> List[bool]:
+        """ Executes each transaction as an `eth_call` against the pending block and returns whether it would succeed.
+
+        Only errors reporting that execution reverted count as failures; if the node could not run the call for any
+        other reason, the transaction is assumed to succeed so that it is still sent.
+        """
+        requests = [("eth_call", [{"from": from_address.address, "to": transact.address.address,
+                                   "data": calldata(transact)}, 'pending']) for transact in transactions]
+
+        return [not ('error' in response and _reverted(response['error'])) for response in self.request(requests)]
+
+    def bids(self, auction, ids: Iterable[int]) -> Iterator:
+        """ Yields the same `Bid` objects as `auction._bids(id)`, reading `batch_size` auctions per round trip """
+        from pymaker.auctions import Flipper, Flapper, Flopper
+        assert isinstance(auction, (Flipper, Flapper, Flopper))
+
+        output_types = [output['type'] for output in auction._contract.get_function_by_name('bids').abi['outputs']]
+        ids = iter(ids)
+
+        while True:
+            chunk = list(itertools.islice(ids, self.batch_size))
+            if not chunk:
+                break
+
+            calls = [(auction.address, auction._contract.encodeABI(fn_name='bids', args=[id])) for id in chunk]
+            for id, data in zip(chunk, self.call(calls)):
+                yield self._bid(auction, id, self.web3.codec.decode_abi(output_types, data))
+
+    def _send(self, payload: List[dict]) -> List[dict]:
+        # Batches bypass web3's middlewares, so they are recorded here
+        start = time.perf_counter()
+        responses = self._post(payload)
+        if self.metrics:
+            self.metrics.record_batch(payload, responses, time.perf_counter() - start)
+
+        return responses
+
+    def _post(self, payload: List[dict]) -> List[dict]:
+        provider = self.web3.provider
+
+        if not isinstance(provider, HTTPProvider):
+            # Providers may serve batches themselves, e.g. the RPC pool or the mock node used by the benchmarks
+            if hasattr(provider, 'make_batch_request'):
+                return provider.make_batch_request(payload)
+            return [provider.make_request(item['method'], item['params']) for item in payload]
+
+        return post_batch(provider, payload)
+
+    @staticmethod
+    def _bid(auction, id: int, array: tuple):
+        # Mirrors the per-contract decoding done by pymaker's `_bids`
+        from pymaker.auctions import Flipper, Flapper, Flopper
+
+        if isinstance(auction, Flipper):
+            return Flipper.Bid(id=id, bid=Rad(array[0]), lot=Wad(array[1]), guy=Address(array[2]),
+                               tic=int(array[3]), end=int(array[4]), usr=Address(array[5]),
+                               gal=Address(array[6]), tab=Rad(array[7]))
+        elif isinstance(auction, Flapper):
+            return Flapper.Bid(id=id, bid=Wad(array[0]), lot=Rad(array[1]), guy=Address(array[2]),
+                               tic=int(array[3]), end=int(array[4]))
+        else:
+            return Flopper.Bid(id=id, bid=Rad(array[0]), lot=Wad(array[1]), guy=Address(array[2]),
+                               tic=int(array[3]), end=int(array[4]))
+
+
+def post_batch(provider: HTTPProvider, payload: List[dict]) -> List[dict]:
+    """ Sends a JSON-RPC batch in a single HTTP request, returning the responses in the order of `payload` """
+    raw_response = make_post_request(provider.endpoint_uri,
+                                     json.dumps(payload).encode('utf-8'),
+                                     **dict(provider.get_request_kwargs()))
+    responses = json.loads(raw_response)
+
+    # Nodes which do not support batching answer with a single error object
+    if isinstance(responses, dict):
+        raise ValueError(responses.get('error', responses))
+
+    by_id = {response['id']: response for response in responses}
+    return [by_id[item['id']] for item in payload]
+
+
+def calldata(transact: Transact) -> str:
+    """ Returns the ABI-encoded call a pymaker `Transact` would send """
+    return transact._contract_function()._encode_transaction_data()
+
+
+def _reverted(error: dict) -> bool:
+    # Geth reports "execution reverted", Parity/OpenEthereum "VM execution error." with the reason in `data`
+    message = f"{error.get('message', '')} {error.get('data', '')}".lower()
+    return any(reason in message for reason in ['revert', 'vm execution error', 'invalid opcode', 'bad instruction'])
@@ -0,0 +1,94 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+from typing import Any, Iterable, Iterator, List, Tuple
+
+from pymaker import Address, Calldata, Invocation, Transact
+from pymaker.transactional import TxManager
+
+from src.batch import BatchCaller, calldata
+
+# Intrinsic cost of a transaction, which a bundled call does not pay again
+BASE_GAS = 21000
+# Cost of TxManager dispatching one call and copying its calldata
+CALL_OVERHEAD = 10000
+
+
+class Bundler:
+    """Packs independent, permissionless calls (e.g. `End.skim`, `End.skip`, `Flap.yank`, `Flop.yank`) into
+    `TxManager.execute` transactions, so each call no longer pays the base cost of a transaction of its own.
+
+    Gas is estimated for `batch_size` calls per round trip and calls are packed until a bundle would exceed
+    `gas_share` of the block gas limit, read once per pack. TxManager reverts the whole bundle if any call reverts,
+    so calls should be simulated first, and a bundle which fails anyway should be `split` and sent again.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, tx_manager: TxManager, batch: BatchCaller, from_address: Address,
+                 fallback_gas: int = 400000, gas_share: float = 0.5):
+        assert isinstance(tx_manager, TxManager)
+        assert isinstance(batch, BatchCaller)
+        assert isinstance(from_address, Address)
+        assert 0 < gas_share <= 1
+
+        self.tx_manager = tx_manager
+        self.batch = batch
+        self.from_address = from_address
+        self.fallback_gas = fallback_gas
+        self.gas_share = gas_share
+
+    def gas_limit(self) -> int:
+        return int(self.batch.web3.eth.getBlock('latest').gasLimit * self.gas_share)
+
+    def pack(self, transactions: Iterable[Tuple[Transact, Any]]) -> Iterator[List[Tuple[Transact, Any]]]:
+        """ Groups `(transact, tag)` pairs as they are produced into bundles which fit the gas limit """
+        transactions = iter(transactions)
+        gas_limit = self.gas_limit()
+        bundle, bundle_gas = [], 0
+
+        while True:
+            chunk = list(itertools.islice(transactions, self.batch.batch_size))
+            if not chunk:
+                break
+
+            estimates = self.batch.estimate_gas([transact for transact, _ in chunk], self.from_address)
+            for item, estimate in zip(chunk, estimates):
+                gas = (estimate or self.fallback_gas) - BASE_GAS + CALL_OVERHEAD
+                if bundle and bundle_gas + gas > gas_limit:
+                    yield bundle
+                    bundle, bundle_gas = [], 0
+                bundle.append(item)
+                bundle_gas += gas
+
+        if bundle:
+            yield bundle
+
+    def transact(self, bundle: List[Tuple[Transact, Any]]) -> Transact:
+        """ A single call is sent as it is, several through `TxManager.execute` """
+        if len(bundle) == 1:
+            return bundle[0][0]
+
+        return self.tx_manager.execute([], [Invocation(transact.address, Calldata(calldata(transact)))
+                                            for transact, _ in bundle])
+
+    @staticmethod
+    def split(bundle: List[Tuple[Transact, Any]]) -> List[List[Tuple[Transact, Any]]]:
+        middle = len(bundle) // 2
+        return [bundle[:middle], bundle[middle:]]
@@ -16,29 +16,49 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import argparse
+import itertools
+import json
 import logging
 import sys
 import time
-from datetime import datetime, timezone
+from datetime import datetime
+import queue
+import threading
 import types
+from concurrent.futures import ThreadPoolExecutor
 from os import path
-from typing import List
+from typing import Iterable, Iterator, List, Tuple
 
 from web3 import Web3
 
-from pymaker import Address, web3_via_http
+from pymaker import Address, Transact, web3_via_http
 from pymaker.gas import DefaultGasPrice, FixedGasPrice
-from pymaker.auctions import Flipper, Flapper, Flopper
 from pymaker.keys import register_keys
 from pymaker.lifecycle import Lifecycle
-from pymaker.numeric import Wad, Rad, Ray
-from pymaker.token import ERC20Token
-from pymaker.deployment import DssDeployment
+from pymaker.numeric import Wad, Rad
 from pymaker.dss import Ilk, Urn
 
-from auction_keeper.urn_history import ChainUrnHistoryProvider
-from auction_keeper.urn_history_vulcanize import VulcanizeUrnHistoryProvider
-from auction_keeper.gas import DynamicGasPrice
+from src.active_auctions import ActiveAuctions
+from src.auction_index import AuctionIndex
+from src.batch import BatchCaller
+from src.cage_watcher import CageWatcher
+from src.journal import ActionJournal
+from src.lazy_deployment import LazyDeployment
+from src.log_scanner import LogScanner
+from src.metrics import Metrics
+from src.plan import FALLBACK_GAS, ShutdownPlan
+from src.priority import Budget, rank, skim_value, skip_value
+from src.rpc_pool import RpcPool, unavailable
+from src.scheduler import Scheduler
+from src.senders import SenderPool, key_addresses
+from src.snapshot import Snapshot, SnapshotUrnHistoryProvider, write_snapshot
+from src.standby import WarmStandby
+from src.thaw import ThawState
+from src.transactions import TransactionPipeline
+from src.urn_index import UrnIndex, IndexedUrnHistoryProvider
+from src.underwater import is_underwater
+from src.urn_table import UrnTable
+from src.vulcanize import PagedVulcanizeUrnHistoryProvider, vulcanize_session
 
 class CageKeeper:
     """Keeper to facilitate Emergency Shutdown"""
@@ -51,11 +71,16 @@ class CageKeeper:
         parser = argparse.ArgumentParser("cage-keeper")
 
         parser.add_argument("--rpc-host", type=str, default="https://localhost:8545",
-                            help="JSON-RPC host:port (default: 'localhost:8545')")
+                            help="JSON-RPC host:port, or several separated by commas to spread requests across them "
+                                 "and fail over between them (default: 'localhost:8545')")
 
         parser.add_argument("--rpc-timeout", type=int, default=1200,
                             help="JSON-RPC timeout (in seconds, default: 10)")
 
+        parser.add_argument("--rpc-hedge-after", type=float, default=1.0,
+                            help="With several --rpc-host endpoints, seconds after which an unanswered read is also sent "
+                                 "to the next fastest endpoint; 0 disables hedging (default: 1.0)")
+
         parser.add_argument("--network", type=str, required=True,
                             help="Network that you're running the Keeper on (options, 'mainnet', 'kovan', 'testnet')")
 
@@ -81,6 +106,104 @@ class CageKeeper:
         parser.add_argument("--vulcanize-key", type=str,
                             help="API key for the Vulcanize endpoint")
 
+        parser.add_argument("--vulcanize-page-size", type=int, default=1000,
+                            help="Number of urns requested in each page from the Vulcanize endpoint (default: 1000)")
+
+        parser.add_argument("--vulcanize-workers", type=int, default=4,
+                            help="Number of pages of each ilk fetched concurrently from the Vulcanize endpoint "
+                                 "(default: 4)")
+
+        parser.add_argument("--urn-index", type=str,
+                            help="SQLite file in which frobbed urns are indexed between runs, so that only new frob "
+                                 "history is queried from the Ethereum node (e.g. /path/to/urns.db)")
+
+        parser.add_argument("--auction-index", type=str,
+                            help="SQLite file in which auctions are indexed from their Kick, deal and yank logs, so "
+                                 "that only auctions still open are read rather than every id ever kicked "
+                                 "(e.g. /path/to/auctions.db)")
+
+        parser.add_argument("--snapshot", type=str,
+                            help="Snapshot file of urns and open auctions to start from, so that only history since "
+                                 "the block it was taken at is read (e.g. /path/to/state.snap)")
+
+        parser.add_argument("--export-snapshot", type=str,
+                            help="Write a snapshot of every urn and open auction to this file and exit, for other "
+                                 "keepers to start from with --snapshot (e.g. /path/to/state.snap)")
+
+        parser.add_argument("--journal", type=str,
+                            help="SQLite file in which planned, submitted and confirmed shutdown actions are recorded, "
+                                 "so that a restarted keeper resumes where it left off (e.g. /path/to/journal.db)")
+
+        parser.add_argument("--warm-standby", dest='warm_standby', action='store_true',
+                            help="While the system is live, keep ilks, active auctions and urn history up to date in the "
+                                 "background so that the processing period starts from a warm state")
+
+        parser.add_argument("--log-scan-workers", type=int, default=4,
+                            help="Number of block ranges whose logs are fetched concurrently when syncing urn and "
+                                 "auction history from the Ethereum node (default: 4)")
+
+        parser.add_argument("--urn-history-workers", type=int, default=4,
+                            help="Number of ilks whose urn history is collected concurrently (default: 4)")
+
+        parser.add_argument("--rpc-batch-size", type=int, default=100,
+                            help="Number of calls sent in each JSON-RPC batch request when scanning auctions (default: 100)")
+
+        parser.add_argument("--max-pending-txs", type=int, default=10,
+                            help="Maximum number of transactions awaiting receipts at any one time (default: 10)")
+
+        parser.add_argument("--fan-out", dest='fan_out', action='store_true',
+                            help="Spread yank, skip and skim transactions across --eth-from and every account given "
+                                 "with --eth-key, each with its own nonces and up to --max-pending-txs in flight")
+
+        parser.add_argument("--min-sender-balance", type=float, default=0.1,
+                            help="With --fan-out, stop sending from an account once its balance falls below this "
+                                 "many ETH (default: 0.1)")
+
+        parser.add_argument("--bundle", dest='bundle', action='store_true',
+                            help="Send yanks, skips and skims in bundles through a TxManager contract owned by "
+                                 "--eth-from, each sized to a share of the block gas limit")
+
+        parser.add_argument("--tx-manager", type=str,
+                            help="With --bundle, address of the TxManager to use; one is deployed on startup if not given")
+
+        parser.add_argument("--bundle-gas-share", type=float, default=0.5,
+                            help="Share of the block gas limit each bundle may use (default: 0.5)")
+
+        parser.add_argument("--prioritize", dest='prioritize', action='store_true',
+                            help="Send skips and skims in order of the debt and collateral each resolves per unit of gas, "
+                                 "rather than in the order urns and auctions are found")
+
+        parser.add_argument("--max-spend", type=float,
+                            help="With --prioritize, stop sending skips and skims once their projected gas cost "
+                                 "reaches this many ETH")
+
+        parser.add_argument("--max-duration", type=int,
+                            help="With --prioritize, stop sending skips and skims this many seconds after "
+                                 "facilitating the processing period began")
+
+        parser.add_argument("--thaw-wakeup", type=int, default=300,
+                            help="Seconds before End.wait elapses at which to resume per-block checks, staying dormant "
+                                 "until then (default: 300)")
+
+        parser.add_argument("--no-preflight", dest='preflight', action='store_false',
+                            help="Send every transaction, rather than first simulating them in batched eth_calls "
+                                 "against the pending block and dropping those which would revert")
+
+        parser.add_argument("--plan-only", type=str,
+                            help="Write a JSON plan of every shutdown action with gas, cost and duration estimates "
+                                 "to this file and exit, without sending any transactions (e.g. /path/to/plan.json)")
+
+        parser.add_argument("--metrics-port", type=int,
+                            help="Serve JSON-RPC and phase metrics in the Prometheus text format on this port at /metrics "
+                                 "(e.g. 8080)")
+
+        parser.add_argument("--metrics-host", type=str, default="127.0.0.1",
+                            help="Interface the metrics endpoint listens on (default: '127.0.0.1')")
+
+        parser.add_argument("--fast-start", dest='fast_start', action='store_true',
+                            help="Only log the End address on startup, so that other contracts of the deployment are "
+                                 "not built until they are needed after cage")
+
         parser.add_argument("--max-errors", type=int, default=100,
                             help="Maximum number of allowed errors before the keeper terminates (default: 100)")
 
@@ -92,41 +215,106 @@ class CageKeeper:
         parser.add_argument("--gas-reactive-multiplier", type=str, default=2.25, help="Gas price multiplier for subsequent tries")
         parser.add_argument("--gas-maximum", type=str, default=5000, help="Maximum gas price in Gwei")
 
-        parser.set_defaults(cageFacilitated=False)
+        parser.set_defaults(cageFacilitated=False, preflight=True)
         self.arguments = parser.parse_args(args)
 
-        self.web3: Web3 = kwargs['web3'] if 'web3' in kwargs else web3_via_http(
-            endpoint_uri=self.arguments.rpc_host, timeout=self.arguments.rpc_timeout, http_pool_size=100)
+        self.web3: Web3 = kwargs['web3'] if 'web3' in kwargs else self.connect(self.arguments.rpc_host.split(','))
+
+        # Innermost, so that requests are measured as they are sent to the node, whatever other middlewares do; bytes
+        # are only counted when the metrics are served
+        self.metrics = Metrics(count_bytes=self.arguments.metrics_port is not None)
+        self.web3.middleware_onion.inject(self.metrics.middleware, layer=0)
 
         self.web3.eth.defaultAccount = self.arguments.eth_from
         register_keys(self.web3, self.arguments.eth_key)
         self.our_address = Address(self.arguments.eth_from)
 
+        # Contracts other than End are only built once they are needed, see `dss`
         if self.arguments.dss_deployment_file:
-            self.dss = DssDeployment.from_json(web3=self.web3, conf=open(self.arguments.dss_deployment_file, "r").read())
+            self.deployment = LazyDeployment(self.web3, conf=open(self.arguments.dss_deployment_file, "r").read())
         else:
-            self.dss = DssDeployment.from_network(web3=self.web3, network=self.arguments.network)
+            self.deployment = LazyDeployment(self.web3, network=self.arguments.network)
 
         self.deployment_block = self.arguments.vat_deployment_block
 
+        # Urn history is kept in an in-memory index unless a persistent one was requested
+        self.urn_index = UrnIndex(self.arguments.urn_index or ":memory:")
+        self.log_scanner = LogScanner(self.web3, workers=self.arguments.log_scan_workers)
+
+        # One keep-alive session serves every page of every ilk
+        if self.arguments.vulcanize_endpoint and self.arguments.vulcanize_key:
+            self.vulcanize_session = vulcanize_session(self.arguments.vulcanize_key,
+                                                       self.arguments.urn_history_workers * self.arguments.vulcanize_workers)
+        else:
+            self.vulcanize_session = None
+
+        self.auction_index = AuctionIndex(self.arguments.auction_index) if self.arguments.auction_index else None
+
+        # Urns changed since the snapshot was taken are indexed apart from the snapshot's own urns
+        self.snapshot = None
+        self.snapshot_index = None
+        if self.arguments.snapshot:
+            self.load_snapshot(self.arguments.snapshot)
+
+        self.batch = BatchCaller(self.web3, self.arguments.rpc_batch_size, self.metrics)
+        self.active_auctions = {}
+        self.standby = None
+
         self.max_errors = self.arguments.max_errors
         self.errors = 0
 
-        self.cageFacilitated = self.arguments.cageFacilitated
+        # Without a journal file, actions are still journaled in memory so that none is sent twice in one run
+        self.journal = ActionJournal(self.arguments.journal if self.arguments.journal else ":memory:")
+
+        self.cageFacilitated = self.arguments.cageFacilitated or self.journal.is_confirmed("processing-period")
 
         self.confirmations = 0
 
+        self.cage_watcher = CageWatcher(self.web3, self.deployment.end)
+        self.scheduler = Scheduler()
+
         # Create gas strategy
         if self.arguments.etherscan_api_key:
+            from auction_keeper.gas import DynamicGasPrice
             self.gas_price = DynamicGasPrice(self.arguments, self.web3)
         else:
             self.gas_price = DefaultGasPrice()
 
+        self.pipeline = TransactionPipeline(self.gas_price, self.arguments.max_pending_txs)
+
+        # Cages, heal, thaw and flows are few and ordered, so only transactions sent in bulk are fanned out
+        if self.arguments.fan_out:
+            self.senders = SenderPool(self.web3, self.batch, self.our_address, key_addresses(self.arguments.eth_key),
+                                      Wad.from_number(self.arguments.min_sender_balance))
+        else:
+            self.senders = None
+
+        # A TxManager is deployed on startup if none was given, see `check_deployment`
+        self.bundler = None
+        if self.arguments.bundle and self.arguments.tx_manager:
+            from pymaker.transactional import TxManager
+            self.bundler = self.create_bundler(TxManager(web3=self.web3, address=Address(self.arguments.tx_manager)))
 
         logging.basicConfig(format='%(asctime)-15s %(levelname)-8s %(message)s',
                             level=(logging.DEBUG if self.arguments.debug else logging.INFO))
 
 
+    @property
+    def dss(self):
+        """ The full deployment, built on first use; while the system is live only `End` is needed """
+        return self.deployment.load()
+
+
+    def connect(self, endpoints: List[str]) -> Web3:
+        """ Connect to a single node directly, or to several through a pool which routes around slow and failing ones """
+        connections = [web3_via_http(endpoint_uri=endpoint.strip(), timeout=self.arguments.rpc_timeout,
+                                     http_pool_size=100) for endpoint in endpoints]
+        if len(connections) == 1:
+            return connections[0]
+
+        return Web3(RpcPool([connection.provider for connection in connections], self.arguments.rpc_hedge_after))
+
+
     def main(self):
         """ Initialize the lifecycle and enter into the Keeper Lifecycle controller
 
@@ -135,29 +323,74 @@ class CageKeeper:
         if it recieves a SIGINT/SIGTERM signal.
 
         """
-        with Lifecycle(self.web3) as lifecycle:
-            self.lifecycle = lifecycle
-            lifecycle.on_startup(self.check_deployment)
-            lifecycle.on_block(self.process_block)
+        if self.arguments.metrics_port is not None:
+            self.metrics.serve(self.arguments.metrics_host, self.arguments.metrics_port)
+
+        try:
+            if self.arguments.plan_only:
+                self.write_plan(self.arguments.plan_only)
+                return
+
+            if self.arguments.export_snapshot:
+                self.export_snapshot(self.arguments.export_snapshot)
+                return
+
+            with Lifecycle(self.web3) as lifecycle:
+                self.lifecycle = lifecycle
+                lifecycle.on_startup(self.startup)
+                lifecycle.on_block(self.process_block)
+        finally:
+            self.metrics.log_summary()
+            self.metrics.stop()
+
+
+    def startup(self):
+        self.check_deployment()
+
+        if self.arguments.warm_standby and not self.cageFacilitated:
+            self.start_standby()
 
 
     def check_deployment(self):
         self.logger.info('')
         self.logger.info('Please confirm the deployment details')
         self.logger.info(f'Keeper Balance: {self.web3.eth.getBalance(self.our_address.address) / (10**18)} ETH')
-        self.logger.info(f'Vat: {self.dss.vat.address}')
-        self.logger.info(f'Vow: {self.dss.vow.address}')
-        self.logger.info(f'Flapper: {self.dss.flapper.address}')
-        self.logger.info(f'Flopper: {self.dss.flopper.address}')
-        self.logger.info(f'Jug: {self.dss.jug.address}')
-        self.logger.info(f'End: {self.dss.end.address}')
+        if not self.arguments.fast_start:
+            self.logger.info(f'Vat: {self.dss.vat.address}')
+            self.logger.info(f'Vow: {self.dss.vow.address}')
+            self.logger.info(f'Flapper: {self.dss.flapper.address}')
+            self.logger.info(f'Flopper: {self.dss.flopper.address}')
+            self.logger.info(f'Jug: {self.dss.jug.address}')
+        self.logger.info(f'End: {self.deployment.end.address}')
+        if self.senders:
+            self.logger.info(f'Senders: {", ".join(str(account) for account in self.senders.accounts)}')
+        if self.arguments.bundle and not self.bundler:
+            from pymaker.transactional import TxManager
+            self.bundler = self.create_bundler(TxManager.deploy(self.web3))
+            self.logger.info(f'Deployed TxManager, pass --tx-manager {self.bundler.tx_manager.address} to reuse it')
+        if self.bundler:
+            self.logger.info(f'TxManager: {self.bundler.tx_manager.address}')
         self.logger.info('')
 
 
+    def create_bundler(self, tx_manager):
+        from src.bundler import Bundler
+
+        # Only the owner may execute through a TxManager, so bundles are never fanned out
+        if tx_manager.owner() != self.our_address:
+            raise ValueError(f"TxManager {tx_manager.address} is not owned by {self.our_address}")
+
+        return Bundler(tx_manager, self.batch, self.our_address, max(FALLBACK_GAS.values()),
+                       self.arguments.bundle_gas_share)
+
+
     def process_block(self):
         """Callback called on each new block. If too many errors, terminate the keeper to minimize potential damage."""
         if self.errors >= self.max_errors:
             self.lifecycle.terminate()
+        elif self.scheduler.is_pending('thaw-wakeup'):
+            # Nothing can happen until the thaw deadline approaches
+            pass
         else:
             try:
                 self.check_cage()
@@ -168,71 +401,200 @@ class CageKeeper:
 
 
     def check_cage(self):
-        """ After live is 0 for 12 block confirmations, facilitate the processing period, then thaw the cage """
+        """ After live is 0 for 12 block confirmations, facilitate the processing period, then thaw the cage.
+
+        A check which fails because the node is unavailable, or with several --rpc-host endpoints every node of the
+        pool is, is retried up to 3 times, 5 seconds apart, before it counts as an error.
+        """
         max_retries = 3
         retry_delay = 5  # seconds
-        
+
         for attempt in range(1, max_retries + 1):
             try:
-                blockNumber = self.web3.eth.blockNumber
-                self.logger.info(f'Checking Cage on block {blockNumber}')
+                return self.check_cage_once()
+            except Exception as e:
+                if attempt == max_retries or not unavailable(e):
+                    raise
+                self.logger.warning(f"RPC connection issue: {str(e)}. Retrying in {retry_delay} seconds "
+                                    f"(attempt {attempt}/{max_retries})...")
+                time.sleep(retry_delay)
 
-                live = self.dss.end.live()
 
-                # Ensure 12 blocks confirmations have passed before facilitating cage
-                if not live and (self.confirmations == 12):
-                    self.logger.info('======== System has been caged ========')
+    def check_cage_once(self):
+        self.logger.debug('Checking Cage')
+        live = self.cage_watcher.live()
 
-                    when = self.dss.end.when()
-                    wait = self.dss.end.wait()
-                    whenInUnix = when.replace(tzinfo=timezone.utc).timestamp()
-                    now = self.web3.eth.getBlock(blockNumber).timestamp
-                    thawedCage = whenInUnix + wait
+        if self.standby:
+            self.standby.notify()
 
-                    if not self.cageFacilitated:
-                        self.cageFacilitated = True
-                        self.facilitate_processing_period()
+        # Ensure 12 blocks confirmations have passed before facilitating cage
+        if not live and (self.confirmations == 12):
+            self.logger.info('======== System has been caged ========')
 
-                    # wait until processing time concludes
-                    elif (now >= thawedCage):
-                        self.thaw_cage()
+            thawedCage = self.cage_watcher.thaw_time()
 
-                        if not (self.arguments.network == 'testnet'):
-                            self.lifecycle.terminate()
+            if not self.cageFacilitated:
+                self.cageFacilitated = True
+                self.stop_standby()
+                self.facilitate_processing_period()
 
-                    else:
-                        whenThawedCage = datetime.utcfromtimestamp(thawedCage)
-                        self.logger.info('')
-                        self.logger.info(f'Cage has been processed and will be thawed on {whenThawedCage.strftime("%m/%d/%Y, %H:%M:%S")} UTC')
-                        self.logger.info('')
-
-                elif not live and self.confirmations < 13:
-                    self.confirmations = self.confirmations + 1
-                    self.logger.info(f'======== System has been caged ( {self.confirmations} confirmations) ========')
-                
-                # If we get here, the operation was successful
-                return
-                
-            except ValueError as e:
-                # Handle specific RPC errors like "No response or no available upstream"
-                error_str = str(e)
-                if "No response or no available upstream" in error_str:
-                    if attempt < max_retries:
-                        self.logger.warning(f"RPC connection issue: {error_str}. Retrying in {retry_delay} seconds (attempt {attempt}/{max_retries})...")
-                        time.sleep(retry_delay)
-                    else:
-                        self.logger.error(f"Failed to connect to RPC after {max_retries} attempts: {error_str}")
-                        self.errors += 1
-                else:
-                    # Other ValueError that's not an RPC connection issue
-                    self.logger.warning(f"ValueError in check_cage: {error_str}")
-                    self.errors += 1
-                    break
-                    
-            except Exception as e:
-                self.logger.warning(f"Error in check_cage: {str(e)}")
-                self.errors += 1
-                break
+            # wait until processing time concludes
+            elif (self.block_timestamp() >= thawedCage):
+                self.thaw_cage()
+
+                if not (self.arguments.network == 'testnet'):
+                    self.lifecycle.terminate()
+
+            else:
+                whenThawedCage = datetime.utcfromtimestamp(thawedCage)
+                self.logger.info('')
+                self.logger.info(f'Cage has been processed and will be thawed on {whenThawedCage.strftime("%m/%d/%Y, %H:%M:%S")} UTC')
+                self.logger.info('')
+                now = self.block_timestamp()
+                self.schedule_thaw_wakeup(thawedCage, now)
+                if thawedCage - now <= self.arguments.thaw_wakeup:
+                    self.prepare_thaw()
+
+        elif not live and self.confirmations < 13:
+            self.confirmations = self.confirmations + 1
+            self.logger.info(f'======== System has been caged ( {self.confirmations} confirmations) ========')
+
+
+    def block_timestamp(self) -> int:
+        return self.web3.eth.getBlock('latest').timestamp
+
+
+    def schedule_thaw_wakeup(self, thawedCage: int, now: int):
+        """ Stay dormant until shortly before the thaw deadline, then resume checking every block.
+
+        The delay is measured against the latest block timestamp rather than the local clock, which may disagree.
+        """
+        delay = thawedCage - self.arguments.thaw_wakeup - now
+        if delay > 0:
+            wakeup = time.time() + delay
+            self.logger.info(f'Sleeping until {datetime.utcfromtimestamp(wakeup).strftime("%m/%d/%Y, %H:%M:%S")} UTC')
+            self.scheduler.schedule('thaw-wakeup', wakeup,
+                                    lambda: self.logger.info('Thaw deadline approaching, checking cage on every block'))
+
+
+    def write_plan(self, filename: str):
+        plan = self.plan().to_dict()
+
+        with open(filename, "w") as file:
+            json.dump(plan, file, indent=2)
+
+        self.logger.info(f'Wrote plan of {sum(stage["count"] for stage in plan["stages"])} transactions to {filename}: '
+                         f'{plan["totalGas"]} gas, {plan["projectedCostEth"]:.4f} ETH, ~{plan["estimatedSeconds"]:.0f}s')
+
+
+    def load_snapshot(self, filename: str):
+        """ Start from a snapshot, seeding the auction index with the auctions open at its block """
+        snapshot = Snapshot.open(filename)
+        if snapshot.end != self.deployment.end.address:
+            raise ValueError(f"Snapshot {filename} was taken of End {snapshot.end}, not {self.deployment.end.address}")
+
+        self.snapshot = snapshot
+        self.snapshot_index = UrnIndex(":memory:")
+
+        if self.auction_index is None:
+            self.auction_index = AuctionIndex(":memory:")
+        for contract in snapshot.auctions:
+            last_block = self.auction_index.last_block(contract)
+            if last_block is None or last_block < snapshot.block:
+                self.auction_index.record(contract, snapshot.auction_ids(contract), [], snapshot.block)
+
+        self.logger.info(f'Loaded snapshot of {len(snapshot.ilks)} ilks and {len(snapshot.auctions)} auction '
+                         f'contracts at block {snapshot.block} from {filename}')
+
+
+    def export_snapshot(self, filename: str):
+        # Anything changed after this block is read again by keepers starting from the snapshot, so the block is
+        # taken before urns and auctions are read rather than after
+        block = self.web3.eth.blockNumber
+
+        # Urns are appended to a compact table per ilk as they are read, never held as one Urn object each
+        ilks = [collateral.ilk for collateral in self.dss.collaterals.values() if collateral.ilk.name != 'SAI']
+        with ThreadPoolExecutor(max_workers=self.arguments.urn_history_workers) as executor:
+            urns = dict(zip([ilk.name for ilk in ilks],
+                            executor.map(lambda ilk: UrnTable(self.urn_history(ilk).iter_urns()), ilks)))
+
+        auctions = self.all_active_auctions()
+        open_ids = {self.dss.flapper.address.address: [bid.id for bid in auctions["flaps"]],
+                    self.dss.flopper.address.address: [bid.id for bid in auctions["flops"]]}
+        for key, bids in auctions["flips"].items():
+            open_ids[self.dss.collaterals[key].flipper.address.address] = [bid.id for bid in bids]
+
+        write_snapshot(filename, block, self.deployment.end.address, urns, open_ids)
+
+        self.logger.info(f'Wrote snapshot of {sum(len(ilk_urns) for ilk_urns in urns.values())} urns and '
+                         f'{sum(len(ids) for ids in open_ids.values())} open auctions at block {block} to {filename}')
+
+
+    def plan(self) -> ShutdownPlan:
+        """ Work out every action facilitating and thawing the cage would take right now, estimating gas in bulk """
+        ilks = self.get_ilks()
+        auctions = self.all_active_auctions()
+        urns = self.get_underwater_urns(ilks)
+
+        latest = self.web3.eth.getBlock('latest')
+        earlier = self.web3.eth.getBlock(max(latest.number - 100, 0))
+        block_time = (latest.timestamp - earlier.timestamp) / max(latest.number - earlier.number, 1)
+        gas_price = self.gas_price.get_gas_price(0) or self.web3.eth.gasPrice
+
+        plan = ShutdownPlan(latest.number, gas_price, block_time, latest.gasLimit, self.arguments.max_pending_txs)
+
+        def add(stage: str, kind: str, ilk_name, transactions: list):
+            plan.add(stage, kind, ilk_name, self.batch.estimate_gas(transactions, self.our_address))
+
+        add("yank", "yank-flap", None, [self.dss.flapper.yank(bid.id) for bid in auctions["flaps"]])
+        add("yank", "yank-flop", None, [self.dss.flopper.yank(bid.id) for bid in auctions["flops"]])
+        for key, bids in auctions["flips"].items():
+            ilk = self.dss.collaterals[key].ilk
+            add("skip", "skip", key, [self.dss.end.skip(ilk, bid.id) for bid in bids])
+
+        skims = {ilk.name: [] for ilk in ilks}
+        for urn in urns:
+            skims[urn.ilk.name].append(self.dss.end.skim(urn.ilk, urn.address))
+
+        for ilk in ilks:
+            add("cage", "cage", ilk.name, [self.dss.end.cage(ilk)])
+            add("skim", "skim", ilk.name, skims[ilk.name])
+            add("flow", "flow", ilk.name, [self.dss.end.flow(ilk)])
+
+        if self.dss.vat.dai(self.dss.vow.address) > Rad(0):
+            add("heal", "heal", None, [self.dss.vow.heal(self.dss.vat.dai(self.dss.vow.address))])
+        add("thaw", "thaw", None, [self.dss.end.thaw()])
+
+        return plan
+
+
+    def start_standby(self):
+        self.logger.info('Starting warm standby')
+        self.standby = WarmStandby(self.refresh_standby)
+
+
+    def stop_standby(self):
+        if self.standby:
+            self.standby.stop()
+            self.standby = None
+
+
+    def refresh_standby(self):
+        """ Bring ilks, active auctions and the urn index up to date, each only reading what changed since last time
+
+        This runs every block, so it neither logs the ilks nor counts towards the ilks and auctions phase metrics.
+        """
+        ilks = self.ilks_with_debt()
+        auctions = self.collect_active_auctions()
+
+        for ilk in ilks:
+            urn_history = self.urn_history(ilk)
+            if isinstance(urn_history, IndexedUrnHistoryProvider):
+                urn_history.sync()
+
+        flips = sum(len(bids) for bids in auctions["flips"].values())
+        self.logger.info(f'Warm standby: {len(ilks)} ilks, {flips} flip, {len(auctions["flaps"])} flap and '
+                         f'{len(auctions["flops"])} flop auctions active')
 
 
     def facilitate_processing_period(self):
@@ -242,6 +604,8 @@ class CageKeeper:
         self.logger.info('')
 
         try:
+            budget = self.budget() if self.arguments.prioritize else None
+
             # check ilks
             ilks = self.get_ilks()
 
@@ -249,73 +613,104 @@ class CageKeeper:
             auctions = self.all_active_auctions()
 
             # Yank all flap and flop auctions
-            self.yank_auctions(auctions["flaps"], auctions["flops"])
-
-            # Cage all ilks
-            for ilk in ilks:
-                try:
-                    self.dss.end.cage(ilk).transact(gas_price=self.gas_price)
-                except Exception as e:
-                    self.logger.warning(f"Error caging ilk {ilk.name}: {str(e)}")
-                    self.errors += 1
-
-            # Skip all flip auctions
-            for key in auctions["flips"].keys():
-                ilk = self.dss.vat.ilk(key)
-                for bid in auctions["flips"][key]:
-                    try:
-                        self.dss.end.skip(ilk,bid.id).transact(gas_price=self.gas_price)
-                    except Exception as e:
-                        self.logger.warning(f"Error skipping auction {bid.id} for ilk {key}: {str(e)}")
-                        self.errors += 1
-
-            #get all underwater urns
-            urns = self.get_underwater_urns(ilks)
-
-            #skim all underwater urns
-            for i in urns:
-                try:
-                    self.dss.end.skim(i.ilk, i.address).transact(gas_price=self.gas_price)
-                except Exception as e:
-                    self.logger.warning(f"Error skimming urn {i.address} for ilk {i.ilk.name}: {str(e)}")
-                    self.errors += 1
+            with self.metrics.phase("yank"):
+                self.yank_auctions(auctions["flaps"], auctions["flops"])
+
+            # Cage all ilks; every cage must be mined before any skip or skim is sent
+            with self.metrics.phase("cage"):
+                self.transact_stage([(self.dss.end.cage(ilk), f"caging ilk {ilk.name}", f"cage:{ilk.name}")
+                                     for ilk in ilks])
+
+            # Skip all flip auctions; skips return debt to urns, so every skip must be mined before skims are sent
+            with self.metrics.phase("skip"):
+                skips = []
+                values = []
+                for key in auctions["flips"].keys():
+                    ilk = self.dss.vat.ilk(key)
+                    mat = self.dss.spotter.mat(ilk) if self.arguments.prioritize else None
+                    for bid in auctions["flips"][key]:
+                        skips.append((self.dss.end.skip(ilk, bid.id), f"skipping auction {bid.id} for ilk {key}",
+                                      f"skip:{key}:{bid.id}"))
+                        if self.arguments.prioritize:
+                            values.append(skip_value(bid.tab.value, bid.lot.value, ilk.spot.value, mat.value))
+
+                if self.arguments.prioritize:
+                    # Skips left out by the budget are still journaled, so that they are retried after a restart
+                    for _, _, key in skips:
+                        self.journal.plan(key)
+                    self.transact_stream(self.prioritize("skip", skips, values, budget), fan_out=True)
+                else:
+                    self.transact_stage(skips, fan_out=True)
+
+            # Skim all underwater urns; unless prioritizing, as soon as they are found, while remaining urn history is
+            # still being fetched
+            with self.metrics.phase("skim"):
+                if self.arguments.prioritize:
+                    self.transact_stream(self.prioritized_skims(ilks, budget), fan_out=True)
+                else:
+                    self.transact_stream(self.skims(ilks), fan_out=True)
+
+            # A restarted keeper only skips the processing period once nothing in it is left to retry
+            unfinished = [key for prefix in ["yank:", "cage:", "skip:", "skim:"]
+                          for key in self.journal.unfinished(prefix)]
+            if unfinished:
+                self.logger.warning(f"{len(unfinished)} actions of the processing period were not confirmed, "
+                                    f"they will be retried if the keeper is restarted")
+            else:
+                self.journal.confirm("processing-period")
         except Exception as e:
             self.logger.warning(f"Error in facilitate_processing_period: {str(e)}")
             self.errors += 1
 
 
+    def prepare_thaw(self):
+        """ Before End.wait is reached, annihilate Dai in the vow, so that End.thaw can be sent as soon as it is """
+        try:
+            state = ThawState.read(self.batch, self.dss)
+            if state.dai > Rad(0) and not state.thawed:
+                with self.metrics.phase("heal"):
+                    self.transact_stage([(self.dss.vow.heal(state.dai), "healing Dai in Vow ahead of thaw",
+                                          f"heal:{self.web3.eth.blockNumber}")])
+        except Exception as e:
+            self.logger.warning(f"Error in prepare_thaw: {str(e)}")
+            self.errors += 1
+
+
     def thaw_cage(self):
-        """ Once End.wait is reached, annihilate any lingering Dai in the vow, thaw the cage, and set the fix for all ilks  """
+        """ Once End.wait is reached, annihilate any lingering Dai in the vow, thaw the cage, and set the fix for all ilks.
+
+        Everything this depends on is read in a single batch first. With --bundle, heal and thaw are sent together in
+        one transaction. All flows are then sent at once, as soon as thaw has been mined.
+        """
         self.logger.info('')
         self.logger.info('======== Thawing Cage ========')
         self.logger.info('')
 
         try:
-            ilks = self.get_ilks()
-
-            # check if Dai is in Vow and annialate it with Heal()
-            dai = self.dss.vat.dai(self.dss.vow.address)
-            if dai > Rad(0):
-                try:
-                    self.dss.vow.heal(dai).transact(gas_price=self.gas_price)
-                except Exception as e:
-                    self.logger.warning(f"Error healing Dai in Vow: {str(e)}")
-                    self.errors += 1
-
-            # Call thaw and Fix outstanding supply of Dai
-            try:
-                self.dss.end.thaw().transact(gas_price=self.gas_price)
-            except Exception as e:
-                self.logger.warning(f"Error thawing the cage: {str(e)}")
-                self.errors += 1
-
-            # Set fix (collateral/Dai ratio) for all Ilks
-            for ilk in ilks:
-                try:
-                    self.dss.end.flow(ilk).transact(gas_price=self.gas_price)
-                except Exception as e:
-                    self.logger.warning(f"Error setting fix for ilk {ilk.name}: {str(e)}")
-                    self.errors += 1
+            with self.metrics.phase("ilks"):
+                state = ThawState.read(self.batch, self.dss)
+            self.logger.info(f'Ilks to flow: {[ilk.name for ilk in state.unflowed]}')
+
+            if not state.thawed:
+                # Dai in the vow is usually healed ahead of the deadline already, see `prepare_thaw`
+                heal = [(self.dss.vow.heal(state.dai), "healing Dai in Vow", "heal")] if state.dai > Rad(0) else []
+                thaw = [(self.dss.end.thaw(), "thawing the cage", "thaw")]
+
+                bundle = list(self.journaled(heal + thaw)) if self.bundler and heal else []
+                if bundle:
+                    with self.metrics.phase("thaw"):
+                        self.transact_bundles([bundle], split=False)
+
+                # Whatever a bundle did not confirm is sent on its own, heal first
+                with self.metrics.phase("heal"):
+                    self.transact_stage(heal)
+                with self.metrics.phase("thaw"):
+                    self.transact_stage(thaw)
+
+            # Set fix (collateral/Dai ratio) for all Ilks; flows are independent of each other, so may be bundled
+            with self.metrics.phase("flow"):
+                self.transact_stage([(self.dss.end.flow(ilk), f"setting fix for ilk {ilk.name}", f"flow:{ilk.name}")
+                                     for ilk in state.unflowed], fan_out=self.bundler is not None)
         except Exception as e:
             self.logger.warning(f"Error in thaw_cage: {str(e)}")
             self.errors += 1
@@ -324,9 +719,8 @@ class CageKeeper:
     def get_ilks(self) -> List[Ilk]:
         """ Use Ilks as saved in https://github.com/makerdao/pymaker/tree/master/config """
 
-        ilks = [self.dss.collaterals[key].ilk for key in self.dss.collaterals.keys()]
-        ilksFiltered = list(filter(lambda l: l.name != 'SAI', ilks))
-        ilks_with_debt = list(filter(lambda l: self.dss.vat.ilk(l.name).art > Wad(0), ilksFiltered))
+        with self.metrics.phase("ilks"):
+            ilks_with_debt = self.ilks_with_debt()
 
         ilkNames = [i.name for i in ilks_with_debt]
 
@@ -335,50 +729,199 @@ class CageKeeper:
         return ilks_with_debt
 
 
-    def get_underwater_urns(self, ilks: List) -> List[Urn]:
-        """ With all urns every frobbed, compile and return a list urns that are under-collateralized up to 100%  """
+    def ilks_with_debt(self) -> List[Ilk]:
+        ilks = [self.dss.collaterals[key].ilk for key in self.dss.collaterals.keys()]
+        ilksFiltered = list(filter(lambda l: l.name != 'SAI', ilks))
+        return list(filter(lambda l: self.dss.vat.ilk(l.name).art > Wad(0), ilksFiltered))
 
-        underwater_urns = []
 
-        for ilk in ilks:
+    def get_underwater_urns(self, ilks: List) -> UrnTable:
+        """ With all urns every frobbed, compile and return a table of urns that are under-collateralized up to 100%  """
 
-            # Use VulcanizeUrnHistoryProvider if vulcanize endpoint is provided, otherwise use ChainUrnHistoryProvider
-            if self.arguments.vulcanize_endpoint and self.arguments.vulcanize_key:
-                urn_history = VulcanizeUrnHistoryProvider(
-                    self.dss,
-                    ilk,
-                    self.arguments.vulcanize_endpoint,
-                    self.arguments.vulcanize_key)
-            else:
-                urn_history = ChainUrnHistoryProvider(
-                    self.web3,
-                    self.dss,
-                    ilk,
-                    self.deployment_block)
+        return UrnTable(self.stream_underwater_urns(ilks))
+
+
+    def skims(self, ilks: List) -> Iterator[Tuple[Transact, str, str]]:
+        """ Yield a skim for every underwater urn still to be skimmed """
+
+        for urn in self.unskimmed_urns(ilks):
+            yield self.skim(urn)
+
+
+    def prioritized_skims(self, ilks: List, budget: Budget) -> Iterator[Tuple[Transact, str, str]]:
+        """ Collect every underwater urn still to be skimmed, then yield skims in order of value per unit of gas """
+
+        mats = {ilk.name: self.dss.spotter.mat(ilk) for ilk in ilks}
+
+        # Urns taken from the journal only carry their address
+        urns = UrnTable(urn if urn.art is not None else self.dss.vat.urn(urn.ilk, urn.address)
+                        for urn in self.unskimmed_urns(ilks))
+        values = [skim_value(urn.ink.value, urn.art.value, urn.ilk.rate.value, urn.ilk.spot.value,
+                             mats[urn.ilk.name].value) for urn in urns]
+
+        return self.prioritize("skim", [self.skim(urn) for urn in urns], values, budget)
+
+
+    def unskimmed_urns(self, ilks: List) -> Iterator[Urn]:
+        """ Yield every underwater urn still to be skimmed, taking urns from the journal for ilks which were already
+        scanned """
+
+        scanned = [ilk for ilk in ilks if self.journal.is_confirmed(f"urns:{ilk.name}")]
+        for ilk in scanned:
+            ilk = self.dss.vat.ilk(ilk.name)
+            keys = self.journal.unfinished(f"skim:{ilk.name}:")
+            self.logger.info(f'Urns of {ilk.name} were already collected, {len(keys)} remain to be skimmed')
+            for key in keys:
+                yield Urn(Address(key.split(':')[2]), ilk)
+
+        unscanned = [ilk for ilk in ilks if ilk.name not in [ilk.name for ilk in scanned]]
+        yield from self.stream_underwater_urns(unscanned, journaled=True)
 
-            urns = urn_history.get_urns()
 
-            self.logger.info(f'Collected {len(urns)} from {ilk}')
+    def budget(self) -> Budget:
+        gas_price = self.gas_price.get_gas_price(0) or self.web3.eth.gasPrice
+        max_spend = int(self.arguments.max_spend * 10**18) if self.arguments.max_spend is not None else None
+        deadline = time.time() + self.arguments.max_duration if self.arguments.max_duration is not None else None
 
-            i = 0
-            for urn in urns.values():
-                urn.ilk = self.dss.vat.ilk(urn.ilk.name)
-                mat = self.dss.spotter.mat(urn.ilk)
-                usdDebt = Ray(urn.art) * urn.ilk.rate
-                usdCollateral = Ray(urn.ink) * urn.ilk.spot * mat
-                # Check if underwater ->  urn.art * ilk.rate > urn.ink * ilk.spot * spotter.mat[ilk]
-                if usdDebt > usdCollateral:
-                    underwater_urns.append(urn)
-                i += 1;
+        return Budget(gas_price, max_spend, deadline)
 
-                if i % 100 == 0:
-                    self.logger.info(f'Processed {i} urns of {ilk.name}')
 
-        return underwater_urns
+    def prioritize(self, kind: str, transactions: List[Tuple[Transact, str, str]], values: List[int],
+                   budget: Budget) -> Iterator[Tuple[Transact, str, str]]:
+        """ Order transactions by value per unit of gas, estimated in bulk, yielding them while the budget lasts """
+
+        # Transactions already confirmed are skipped later anyway, and must not use up the budget
+        pending = [index for index, (_, _, key) in enumerate(transactions) if not self.journal.is_confirmed(key)]
+        transactions = [transactions[index] for index in pending]
+        values = [values[index] for index in pending]
+
+        gas = self.batch.estimate_gas([transact for transact, _, _ in transactions], self.our_address)
+        ranked = rank(transactions, values, gas, FALLBACK_GAS[kind])
+
+        self.logger.info(f'Prioritized {len(ranked)} {kind} transactions resolving '
+                         f'{sum(value for value in values) / 10**45:.2f} Dai of debt and collateral')
+        return budget.take(kind, ranked)
+
+
+    def skim(self, urn: Urn) -> Tuple[Transact, str, str]:
+        return (self.dss.end.skim(urn.ilk, urn.address), f"skimming urn {urn.address} for ilk {urn.ilk.name}",
+                f"skim:{urn.ilk.name}:{urn.address.address}")
+
+
+    def stream_underwater_urns(self, ilks: List, journaled: bool = False) -> Iterator[Urn]:
+        """ Yield under-collateralized urns as soon as they are evaluated, collecting the history of ilks concurrently.
+
+        At most `--max-pending-txs` evaluated urns are buffered, so memory stays bounded no matter how many vaults exist.
+        If `journaled`, each skim is planned in the journal before its urn is yielded, and each ilk is recorded as
+        scanned once all of its urns have been evaluated.
+        """
+
+        found = queue.Queue(maxsize=self.arguments.max_pending_txs)
+        stopped = threading.Event()
+        done = object()
+
+        def collect(ilk: Ilk):
+            try:
+                for urn in self.underwater_urns_of(ilk):
+                    if journaled:
+                        self.journal.plan(self.skim(urn)[2])
+                    while not stopped.is_set():
+                        try:
+                            found.put(urn, timeout=1)
+                            break
+                        except queue.Full:
+                            pass
+
+                if journaled and not stopped.is_set():
+                    self.journal.confirm(f"urns:{ilk.name}")
+            finally:
+                found.put(done)
+
+        # Urn history of each ilk is independent and I/O bound, so ilks are collected concurrently
+        with self.metrics.phase("urns"), ThreadPoolExecutor(max_workers=self.arguments.urn_history_workers) as executor:
+            futures = [executor.submit(collect, ilk) for ilk in ilks]
+            try:
+                remaining = len(futures)
+                while remaining > 0:
+                    urn = found.get()
+                    if urn is done:
+                        remaining -= 1
+                    else:
+                        yield urn
+            finally:
+                stopped.set()
+                # Unblock workers still waiting to report that they are done
+                while any(not future.done() for future in futures):
+                    try:
+                        found.get(timeout=1)
+                    except queue.Empty:
+                        pass
+
+        for future in futures:
+            future.result()
+
+
+    def underwater_urns_of(self, ilk: Ilk) -> Iterator[Urn]:
+        """ Yield the under-collateralized urns of a single ilk as its urn history is read  """
+
+        urns = self.urn_history(ilk).iter_urns()
+
+        # rate, spot and mat are constant for the ilk, so read them once rather than once per urn
+        ilk = self.dss.vat.ilk(ilk.name)
+        mat = self.dss.spotter.mat(ilk)
+
+        i = 0
+        for urn in urns:
+            # Check if underwater ->  urn.art * ilk.rate > urn.ink * ilk.spot * spotter.mat[ilk]
+            if is_underwater(urn.ink.value, urn.art.value, ilk.rate.value, ilk.spot.value, mat.value):
+                # Urns may be read-only views, e.g. of a snapshot, so they are copied rather than given the ilk
+                yield Urn(urn.address, ilk, urn.ink, urn.art)
+            i += 1
+
+            if i % 1000 == 0:
+                self.logger.info(f'Processed {i} urns of {ilk.name}')
+
+        self.logger.info(f'Collected and processed {i} urns of {ilk.name}')
+
+
+    def urn_history(self, ilk: Ilk):
+        """ Use PagedVulcanizeUrnHistoryProvider if vulcanize endpoint is provided, SnapshotUrnHistoryProvider for ilks
+        in the snapshot started from, otherwise IndexedUrnHistoryProvider """
+
+        if self.arguments.vulcanize_endpoint and self.arguments.vulcanize_key:
+            return PagedVulcanizeUrnHistoryProvider(
+                ilk,
+                self.arguments.vulcanize_endpoint,
+                self.vulcanize_session,
+                self.arguments.vulcanize_page_size,
+                self.arguments.vulcanize_workers)
+        elif self.snapshot and ilk.name in self.snapshot.ilks:
+            return SnapshotUrnHistoryProvider(
+                self.web3,
+                self.dss,
+                ilk,
+                self.snapshot,
+                self.snapshot_index,
+                self.log_scanner,
+                batch=self.batch)
+        else:
+            return IndexedUrnHistoryProvider(
+                self.web3,
+                self.dss,
+                ilk,
+                self.deployment_block,
+                self.urn_index,
+                self.log_scanner,
+                batch=self.batch)
 
 
     def all_active_auctions(self) -> dict:
         """ Aggregates active auctions that meet criteria to be called after Cage """
+        with self.metrics.phase("auctions"):
+            return self.collect_active_auctions()
+
+
+    def collect_active_auctions(self) -> dict:
         flips = {}
         for collateral in self.dss.collaterals.values():
             # Each collateral has it's own flip contract; add auctions from each.
@@ -392,46 +935,119 @@ class CageKeeper:
 
 
     def cage_active_auctions(self, parentObj) -> List:
-        """ Returns auctions that meet the requiremenets to be called by End.skip, Flap.yank, and Flop.yank """
-        active_auctions = []
-        auction_count = parentObj.kicks()+1
-
-        # flip auctions
-        if isinstance(parentObj, Flipper):
-            for index in range(1, auction_count):
-                bid = parentObj._bids(index)
-                if bid.guy != Address("0x0000000000000000000000000000000000000000"):
-                    if bid.bid < bid.tab:
-                        active_auctions.append(bid)
-                index += 1
-
-        # flap and flop auctions
-        else:
-            for index in range(1, auction_count):
-                bid = parentObj._bids(index)
-                if bid.guy != Address("0x0000000000000000000000000000000000000000"):
-                    active_auctions.append(bid)
-                index += 1
+        """ Returns auctions that meet the requiremenets to be called by End.skip, Flap.yank, and Flop.yank
 
+        Auctions are tracked between calls, so only previously active and newly kicked auctions are read again;
+        with an auction index, only auctions whose logs show them still open are read.
+        """
+        if parentObj.address not in self.active_auctions:
+            self.active_auctions[parentObj.address] = ActiveAuctions(parentObj, self.batch, self.auction_index,
+                                                                     self.log_scanner, self.deployment_block)
 
-        return active_auctions
+        return self.active_auctions[parentObj.address].refresh()
 
 
     def yank_auctions(self, flapBids: List, flopBids: List):
         """ Calls Flap.yank and Flop.yank on all auctions ids that meet the cage criteria """
-        for bid in flapBids:
-            try:
-                self.dss.flapper.yank(bid.id).transact(gas_price=self.gas_price)
-            except Exception as e:
-                self.logger.warning(f"Error yanking flap auction {bid.id}: {str(e)}")
-                self.errors += 1
+        yanks = [(self.dss.flapper.yank(bid.id), f"yanking flap auction {bid.id}", f"yank:flap:{bid.id}")
+                 for bid in flapBids]
+        yanks += [(self.dss.flopper.yank(bid.id), f"yanking flop auction {bid.id}", f"yank:flop:{bid.id}")
+                  for bid in flopBids]
 
-        for bid in flopBids:
-            try:
-                self.dss.flopper.yank(bid.id).transact(gas_price=self.gas_price)
-            except Exception as e:
-                self.logger.warning(f"Error yanking flop auction {bid.id}: {str(e)}")
-                self.errors += 1
+        self.transact_stage(yanks, fan_out=True)
+
+
+    def transact_stage(self, transactions: List[Tuple[Transact, str, str]], fan_out: bool = False) -> int:
+        """ Sends independent transactions concurrently and waits for all of them, skipping any the journal has
+        already confirmed. Each transaction is a `(transact, description, journal key)` tuple. """
+        return self.transact_stream(transactions, fan_out)
+
+
+    def transact_stream(self, transactions: Iterable[Tuple[Transact, str, str]], fan_out: bool = False) -> int:
+        """ Sends independent transactions concurrently as they are produced, skipping any the journal has
+        already confirmed, and warning about each one that raised an error. If `fan_out` and `--fan-out` was given,
+        they are spread across all sender accounts; if `fan_out` and `--bundle` was given, they are bundled instead. """
+
+        unconfirmed = self.journaled(transactions)
+        transactions = self.preflight(unconfirmed) if self.arguments.preflight else unconfirmed
+
+        if fan_out and self.bundler:
+            return self.transact_bundles(self.bundler.pack(transactions))
+
+        return self.pipeline.execute_stream(transactions, self.report_transaction,
+                                            lambda tag: self.journal.record(tag[1], ActionJournal.SUBMITTED),
+                                            self.senders if fan_out else None)
+
+
+    def journaled(self, transactions: Iterable[Tuple[Transact, str, str]]) -> Iterator[Tuple[Transact, tuple]]:
+        """ Yield `(transact, (description, key))` for each transaction the journal has not confirmed yet, planning it """
+        for transact, description, key in transactions:
+            if self.journal.is_confirmed(key):
+                self.logger.debug(f"Not {description}, already confirmed")
+                continue
+
+            self.journal.plan(key)
+            yield transact, (description, key)
+
+
+    def transact_bundles(self, bundles: Iterable[List[Tuple[Transact, tuple]]], split: bool = True) -> int:
+        """ Sends bundles of calls through the TxManager. A bundle which fails is split in two and both halves are
+        sent again, until each call has either been mined or has failed on its own; without `split`, the calls of a
+        bundle which fails are left unconfirmed instead. """
+
+        def submitted(bundle: List[Tuple[Transact, tuple]]):
+            for _, (_, key) in bundle:
+                self.journal.record(key, ActionJournal.SUBMITTED)
+
+        def report(bundle: List[Tuple[Transact, tuple]], result):
+            if len(bundle) > 1 and (result is None or isinstance(result, Exception)):
+                if split:
+                    self.logger.info(f"Bundle of {len(bundle)} calls failed, splitting it")
+                    failed.extend(self.bundler.split(bundle))
+                else:
+                    self.logger.info(f"Bundle of {len(bundle)} calls failed")
+            else:
+                for _, tag in bundle:
+                    self.report_transaction(tag, result)
+
+        count = 0
+        while True:
+            failed = []
+            count += self.pipeline.execute_stream(((self.bundler.transact(bundle), bundle) for bundle in bundles),
+                                                  report, submitted)
+            if not failed:
+                return count
+            bundles = failed
+
+
+    def preflight(self, transactions: Iterator[Tuple[Transact, tuple]]) -> Iterator[Tuple[Transact, tuple]]:
+        """ Simulate transactions in batches of `--max-pending-txs`, only passing on those which would succeed """
+        while True:
+            chunk = list(itertools.islice(transactions, self.arguments.max_pending_txs))
+            if not chunk:
+                break
+
+            outcomes = self.batch.simulate([transact for transact, _ in chunk], self.our_address)
+            for (transact, tag), succeeds in zip(chunk, outcomes):
+                if succeeds:
+                    yield transact, tag
+                else:
+                    # e.g. already done by another keeper, so it is not retried after a restart either
+                    self.logger.info(f"Not {tag[0]}, it would revert")
+                    self.journal.record(tag[1], ActionJournal.SKIPPED)
+
+
+    def report_transaction(self, tag: Tuple[str, str], result):
+        description, key = tag
+
+        if isinstance(result, Exception):
+            self.logger.warning(f"Error {description}: {str(result)}")
+            self.errors += 1
+            self.journal.record(key, ActionJournal.FAILED)
+        elif result is None:
+            self.journal.record(key, ActionJournal.FAILED)
+        else:
+            self.journal.confirm(key, result.transaction_hash.hex())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,117 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+from datetime import datetime, timezone
+from typing import Tuple
+
+from web3 import Web3
+
+from pymaker.shutdown import End
+
+# Older End deployments emit an anonymous LogNote whose first topic is the `cage()` selector,
+# newer ones emit a `Cage()` event.
+CAGE_NOTE_TOPIC = Web3.toHex(Web3.keccak(text="cage()")[:4] + bytes(28))
+CAGE_EVENT_TOPIC = Web3.toHex(Web3.keccak(text="Cage()"))
+
+
+class CageWatcher:
+    """Detects `End.cage()` from the End contract's logs instead of calling `End.live()` on every block.
+
+    The log filter is polled once per check, which costs a single `eth_getFilterChanges` round trip while the
+    system is live.  `End.live()` is read when the filter is (re)installed, so a cage which happened before the
+    filter existed is not missed, and on every check if the node does not support log filters at all.
+    Once a cage log has been seen, `End.live()` is read on every check until it confirms the cage, so neither a failed
+    read nor one served by a node which is behind loses the log; only once `confirmations` blocks have passed without
+    it is the log taken to have been reorganized away.
+    `End.when()` and `End.wait()` never change once caged, so they are only read once.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, web3: Web3, end: End, confirmations: int = 12):
+        assert isinstance(web3, Web3)
+        assert isinstance(end, End)
+        assert isinstance(confirmations, int)
+
+        self.web3 = web3
+        self.end = end
+        self.filter = None
+        self.filters_supported = True
+        self.confirmations = confirmations
+        self.cage_block = None
+        self.caged = False
+        self._when = None
+        self._wait = None
+
+    def live(self) -> bool:
+        if self.caged:
+            return False
+
+        if not self.filters_supported:
+            self.caged = not self.end.live()
+            return not self.caged
+
+        if self.filter is None:
+            self._install_filter()
+            self.caged = not self.end.live()
+            return not self.caged
+
+        try:
+            entries = self.filter.get_new_entries()
+        except Exception as e:
+            # Nodes drop filters on restart or after a period of inactivity, and load balancers may route
+            # the poll to a node which never knew about it; reinstall it on the next check
+            self.logger.debug(f"Lost End log filter: {str(e)}")
+            self.filter = None
+            self.caged = not self.end.live()
+            return not self.caged
+
+        if len(entries) > 0:
+            self.cage_block = max(entry['blockNumber'] for entry in entries)
+
+        if self.cage_block is not None:
+            # Confirm with the contract itself, in case the log came from a block which was reorganized
+            self.caged = not self.end.live()
+            if not self.caged and self.web3.eth.blockNumber > self.cage_block + self.confirmations:
+                self.logger.warning(f"End.cage() logged in block {self.cage_block} was not confirmed by End.live()")
+                self.cage_block = None
+
+        return not self.caged
+
+    def when_and_wait(self) -> Tuple[datetime, int]:
+        """ Returns `End.when()` and `End.wait()`, which are immutable once caged """
+        assert self.caged
+
+        if self._when is None:
+            self._when = self.end.when()
+            self._wait = self.end.wait()
+
+        return self._when, self._wait
+
+    def thaw_time(self) -> int:
+        """ Returns the unix timestamp after which the cage can be thawed """
+        when, wait = self.when_and_wait()
+        return int(when.replace(tzinfo=timezone.utc).timestamp()) + wait
+
+    def _install_filter(self):
+        try:
+            self.filter = self.web3.eth.filter({'address': self.end.address.address,
+                                                'topics': [[CAGE_NOTE_TOPIC, CAGE_EVENT_TOPIC]]})
+        except Exception as e:
+            self.logger.info(f"Log filters are not available ({str(e)}), polling End.live() on each block instead")
+            self.filters_supported = False
@@ -0,0 +1,92 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+
+class ActionJournal:
+    """SQLite file recording the status of every shutdown action, keyed by strings such as `skim:ETH-A:0x12ab..`.
+
+    Actions move from `planned` to `submitted` to either `confirmed` or `failed`, or straight to `skipped` when
+    pre-flight simulation shows they would revert, e.g. because another keeper got there first.  Only confirmed and
+    skipped actions are finished: anything else is retried after a restart, which is cheap because pymaker estimates
+    gas before sending and so never pays for a transaction which would revert.
+    """
+
+    PLANNED = 'planned'
+    SUBMITTED = 'submitted'
+    CONFIRMED = 'confirmed'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, path: str):
+        assert isinstance(path, str)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS actions (key TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                            "tx_hash TEXT, updated INTEGER NOT NULL)")
+
+    def status(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT status FROM actions WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def is_confirmed(self, key: str) -> bool:
+        return self.status(key) == ActionJournal.CONFIRMED
+
+    def plan(self, key: str):
+        """ Records an action as planned, unless it is already known """
+        with self.lock, self.db:
+            self.db.execute("INSERT OR IGNORE INTO actions (key, status, updated) VALUES (?, ?, ?)",
+                            (key, ActionJournal.PLANNED, int(time.time())))
+
+    def record(self, key: str, status: str, tx_hash: Optional[str] = None):
+        """ Records the latest status of an action; a confirmed action is never downgraded """
+        assert status in [ActionJournal.PLANNED, ActionJournal.SUBMITTED, ActionJournal.CONFIRMED, ActionJournal.FAILED,
+                          ActionJournal.SKIPPED]
+
+        with self.lock, self.db:
+            self.db.execute("INSERT INTO actions (key, status, tx_hash, updated) VALUES (?, ?, ?, ?) "
+                            "ON CONFLICT(key) DO UPDATE SET status = excluded.status, "
+                            "tx_hash = COALESCE(excluded.tx_hash, actions.tx_hash), updated = excluded.updated "
+                            "WHERE actions.status != ?",
+                            (key, status, tx_hash, int(time.time()), ActionJournal.CONFIRMED))
+
+    def confirm(self, key: str, tx_hash: Optional[str] = None):
+        self.record(key, ActionJournal.CONFIRMED, tx_hash)
+
+    def unconfirmed(self, prefix: str) -> List[str]:
+        """ Returns the keys starting with `prefix` of every action which has not been confirmed """
+        with self.lock:
+            rows = self.db.execute("SELECT key FROM actions WHERE substr(key, 1, ?) = ? AND status != ? ORDER BY key",
+                                   (len(prefix), prefix, ActionJournal.CONFIRMED)).fetchall()
+        return [row[0] for row in rows]
+
+    def unfinished(self, prefix: str) -> List[str]:
+        """ Returns the keys starting with `prefix` of every action which has been neither confirmed nor skipped """
+        with self.lock:
+            rows = self.db.execute("SELECT key FROM actions WHERE substr(key, 1, ?) = ? AND status NOT IN (?, ?) "
+                                   "ORDER BY key", (len(prefix), prefix, ActionJournal.CONFIRMED,
+                                                    ActionJournal.SKIPPED)).fetchall()
+        return [row[0] for row in rows]
@@ -0,0 +1,88 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import importlib.util
+import json
+import logging
+import threading
+import time
+from os import path
+from typing import Optional
+
+from web3 import Web3
+
+from pymaker import Address
+from pymaker.shutdown import End
+
+
+class LazyDeployment:
+    """Builds pymaker's `DssDeployment`, with a contract object for every collateral, only when it is first needed.
+
+    While the system is live the keeper only reads `End`, which is built on its own from the address in the
+    deployment configuration. The configuration is either the given JSON or that of a network known to pymaker.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, web3: Web3, conf: Optional[str] = None, network: Optional[str] = None):
+        assert isinstance(web3, Web3)
+        assert conf is not None or network is not None
+
+        self.web3 = web3
+        self.conf = conf if conf is not None else network_conf(network)
+        self.network = network
+        self.lock = threading.Lock()
+        self._end = None
+        self._deployment = None
+
+    @property
+    def end(self) -> End:
+        if self._end is None:
+            addresses = json.loads(self.conf) if self.conf is not None else {}
+            self._end = End(self.web3, Address(addresses['MCD_END'])) if 'MCD_END' in addresses else self.load().end
+
+        return self._end
+
+    def load(self):
+        """ Returns the full deployment, building it on the first call """
+        with self.lock:
+            if self._deployment is None:
+                from pymaker.deployment import DssDeployment
+
+                start = time.perf_counter()
+                if self.conf is not None:
+                    self._deployment = DssDeployment.from_json(web3=self.web3, conf=self.conf)
+                else:
+                    self._deployment = DssDeployment.from_network(web3=self.web3, network=self.network)
+                self.logger.debug(f"Loaded the deployment in {time.perf_counter() - start:.2f}s")
+
+            return self._deployment
+
+
+def network_conf(network: str) -> Optional[str]:
+    """ Reads the `config/{network}-addresses.json` file `DssDeployment.from_network` would load, found next to the
+    pymaker package, or returns None if it is not there (e.g. pymaker was installed without its config) """
+    spec = importlib.util.find_spec('pymaker')
+    if spec is None or spec.origin is None:
+        return None
+
+    filename = path.join(path.dirname(path.realpath(spec.origin)), "..", "config", f"{network}-addresses.json")
+    if not path.isfile(filename):
+        return None
+
+    with open(filename, "r") as file:
+        return file.read()
@@ -0,0 +1,132 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List, Tuple
+
+from requests.exceptions import Timeout
+from web3 import Web3
+
+# Substrings of the errors nodes and providers return when a range holds too many logs or takes too long to query
+RANGE_ERRORS = ["more than", "too many", "limit", "exceed", "response size", "timeout", "timed out"]
+
+
+class LogScanner:
+    """Fetches logs over a block range with concurrent `eth_getLogs` requests whose size adapts to the node.
+
+    The range of each request grows while results are sparse and shrinks as they approach `target` logs. A range
+    the node rejects for returning too many results, or times out on, is split in two and retried. The window
+    learnt is kept between scans, so each scan starts at the size the node last sustained.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, web3: Web3, window: int = 10000, min_window: int = 1, max_window: int = 1000000,
+                 target: int = 1000, workers: int = 4):
+        assert isinstance(web3, Web3)
+        assert 0 < min_window <= window <= max_window
+        assert target > 0
+        assert workers > 0
+
+        self.web3 = web3
+        self.window = window
+        self.min_window = min_window
+        self.max_window = max_window
+        self.target = target
+        self.workers = workers
+        self.lock = threading.Lock()
+
+    def scan(self, filter_params: dict, from_block: int, to_block: int) -> Iterator[Tuple[int, int, List]]:
+        """ Yields `(first block, last block, logs)` for consecutive ranges covering `from_block` to `to_block`.
+
+        Ranges are fetched concurrently but yielded in block order, so a caller may record progress after each one.
+        """
+        next_block = from_block
+        next_yield = from_block
+        retries = deque()
+        fetched = {}
+        in_flight = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while next_yield <= to_block:
+                    # Keep every worker busy, without buffering too far ahead of the range yielded next. Split ranges
+                    # are always retried, however full the buffer, as the range yielded next may be one of them
+                    while len(in_flight) < self.workers and \
+                            (retries or (next_block <= to_block and len(fetched) < self.workers * 4)):
+                        if retries:
+                            start, end = retries.popleft()
+                        else:
+                            start, end = next_block, min(next_block + self.window - 1, to_block)
+                            next_block = end + 1
+                        in_flight[executor.submit(self.get_logs, filter_params, start, end)] = (start, end)
+
+                    # The range yielded next is always in flight or fetched here, so this never waits on nothing
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED) if in_flight else (set(), set())
+                    for future in done:
+                        start, end = in_flight.pop(future)
+                        try:
+                            logs = future.result()
+                        except Exception as e:
+                            if start == end or not self.is_range_error(e):
+                                raise
+                            self.shrink(end - start + 1)
+                            self.logger.debug(f"Splitting blocks {start}-{end} after {type(e).__name__}: {e}")
+                            middle = (start + end) // 2
+                            retries.extendleft([(middle + 1, end), (start, middle)])
+                            continue
+
+                        self.adapt(end - start + 1, len(logs))
+                        fetched[start] = (end, logs)
+
+                    while next_yield in fetched:
+                        end, logs = fetched.pop(next_yield)
+                        yield next_yield, end, logs
+                        next_yield = end + 1
+            finally:
+                for future in in_flight:
+                    future.cancel()
+
+    def head(self) -> int:
+        """ Returns the last block logs can be scanned up to """
+        # Requests to a pool of nodes may each be served by a different node, so a scan stops at the lowest head
+        # among them; a node which is behind would otherwise answer for blocks it has not seen with no logs
+        if hasattr(self.web3.provider, 'lowest_head'):
+            return self.web3.provider.lowest_head()
+        return self.web3.eth.blockNumber
+
+    def get_logs(self, filter_params: dict, start: int, end: int) -> List:
+        return self.web3.eth.getLogs({**filter_params, 'fromBlock': start, 'toBlock': end})
+
+    def adapt(self, size: int, count: int):
+        """ Sizes the next ranges from the number of logs `size` blocks returned """
+        with self.lock:
+            if count > self.target:
+                self.window = max(self.min_window, size * self.target // count)
+            elif count < self.target // 2:
+                self.window = max(self.window, min(self.max_window, size * 2))
+
+    def shrink(self, size: int):
+        with self.lock:
+            self.window = max(self.min_window, min(self.window, size // 2))
+
+    @staticmethod
+    def is_range_error(e: Exception) -> bool:
+        return isinstance(e, Timeout) or any(error in str(e).lower() for error in RANGE_ERRORS)
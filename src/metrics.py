@@ -0,0 +1,207 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Callable, List
+
+from web3 import Web3
+
+# Upper bounds of the latency histogram buckets, in seconds; the last bucket is unbounded
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class MethodStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.seconds = 0.0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def observe(self, seconds: float):
+        self.seconds += seconds
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def quantile(self, q: float) -> float:
+        """ Upper bound of the bucket holding the `q` quantile of observed latencies """
+        observed = sum(self.buckets)
+        running = 0
+        for bound, count in zip(LATENCY_BUCKETS + [float('inf')], self.buckets):
+            running += count
+            if observed > 0 and running >= q * observed:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    """Counts JSON-RPC calls, bytes and latencies per method, and times each keeper phase.
+
+    Install `middleware` on a web3 instance to record every request made through it. Batches sent by `BatchCaller`
+    bypass web3 and are recorded through `record_batch`: each call counts towards its method, while the latency of
+    the round trip is observed once, under `batch`. Phases may overlap, e.g. urns are collected while being skimmed.
+
+    Counting bytes means encoding every request and response again, which is costly for large log and batch
+    responses, so it is only done with `count_bytes`; calls, errors and latencies are always counted.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, count_bytes: bool = True):
+        self.count_bytes = count_bytes
+        self.lock = threading.Lock()
+        self.methods = {}
+        self.phases = {}
+        self.server = None
+
+    def middleware(self, make_request: Callable, web3: Web3) -> Callable:
+        def middleware(method, params):
+            start = time.perf_counter()
+            try:
+                response = make_request(method, params)
+            except Exception:
+                self.record(method, time.perf_counter() - start, self._size(params), 0, True)
+                raise
+            self.record(method, time.perf_counter() - start, self._size(params), self._size(response),
+                        'error' in response)
+            return response
+
+        return middleware
+
+    def record(self, method: str, seconds: float, bytes_sent: int, bytes_received: int, error: bool):
+        with self.lock:
+            stats = self._stats(method)
+            stats.count += 1
+            stats.errors += int(error)
+            stats.bytes_sent += bytes_sent
+            stats.bytes_received += bytes_received
+            stats.observe(seconds)
+
+    def record_batch(self, payload: List[dict], responses: List[dict], seconds: float):
+        with self.lock:
+            for item, response in zip(payload, responses):
+                stats = self._stats(item['method'])
+                stats.count += 1
+                stats.errors += int('error' in response)
+
+            stats = self._stats('batch')
+            stats.count += 1
+            stats.bytes_sent += self._size(payload)
+            stats.bytes_received += self._size(responses)
+            stats.observe(seconds)
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                runs, seconds = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (runs + 1, seconds + time.perf_counter() - start)
+
+    def _size(self, value) -> int:
+        return _size(value) if self.count_bytes else 0
+
+    def _stats(self, method: str) -> MethodStats:
+        if method not in self.methods:
+            self.methods[method] = MethodStats()
+        return self.methods[method]
+
+    def prometheus(self) -> str:
+        """ Renders all metrics in the Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            for method, stats in sorted(self.methods.items()):
+                labels = f'method="{method}"'
+                lines.append(f'cage_keeper_rpc_requests_total{{{labels}}} {stats.count}')
+                lines.append(f'cage_keeper_rpc_errors_total{{{labels}}} {stats.errors}')
+                lines.append(f'cage_keeper_rpc_bytes_sent_total{{{labels}}} {stats.bytes_sent}')
+                lines.append(f'cage_keeper_rpc_bytes_received_total{{{labels}}} {stats.bytes_received}')
+                running = 0
+                for bound, count in zip(LATENCY_BUCKETS + ['+Inf'], stats.buckets):
+                    running += count
+                    lines.append(f'cage_keeper_rpc_latency_seconds_bucket{{{labels},le="{bound}"}} {running}')
+                lines.append(f'cage_keeper_rpc_latency_seconds_sum{{{labels}}} {stats.seconds}')
+                lines.append(f'cage_keeper_rpc_latency_seconds_count{{{labels}}} {running}')
+
+            for phase, (runs, seconds) in sorted(self.phases.items()):
+                lines.append(f'cage_keeper_phase_runs_total{{phase="{phase}"}} {runs}')
+                lines.append(f'cage_keeper_phase_seconds_total{{phase="{phase}"}} {seconds}')
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, host: str, port: int):
+        """ Serves `prometheus()` at http://host:port/metrics from a daemon thread """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.logger.info(f'Serving metrics on http://{host}:{self.server.server_address[1]}/metrics')
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def log_summary(self):
+        with self.lock:
+            methods = sorted(self.methods.items(), key=lambda item: -item[1].seconds)
+            phases = sorted(self.phases.items(), key=lambda item: -item[1][1])
+
+        if not methods and not phases:
+            return
+
+        self.logger.info('======== RPC and phase summary ========')
+        for method, stats in methods:
+            self.logger.info(f'{method}: {stats.count} calls, {stats.errors} errors, {stats.seconds:.2f}s, '
+                             f'p50 <= {stats.quantile(0.5)}s, p95 <= {stats.quantile(0.95)}s, '
+                             f'{stats.bytes_sent} bytes sent, {stats.bytes_received} bytes received')
+        for phase, (runs, seconds) in phases:
+            self.logger.info(f'{phase}: {runs} runs, {seconds:.2f}s')
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _size(value) -> int:
+    # Size of the JSON encoding, which is what crosses the wire for HTTP providers
+    return len(json.dumps(value, default=str))
@@ -0,0 +1,99 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from typing import List, Optional
+
+# Conservative upper bounds measured with eth_estimateGas on Kovan (see README).  Most shutdown actions revert
+# while the system is live, so these are used for any action which cannot be estimated yet.
+FALLBACK_GAS = {
+    "yank-flap": 154892,
+    "yank-flop": 196605,
+    "cage": 187083,
+    "skip": 389191,
+    "skim": 223399,
+    "heal": 166397,
+    "thaw": 157094,
+    "flow": 159159
+}
+
+# Stages are executed in this order, each waiting for the previous one to be mined
+STAGES = ["yank", "cage", "skip", "skim", "heal", "thaw", "flow"]
+
+
+class ShutdownPlan:
+    """Machine-readable summary of every action the keeper would take, with gas, cost and duration estimates.
+
+    Each stage needs at least one block per `concurrency` transactions and one block per `block_gas_limit`
+    of gas, whichever is more.
+    """
+
+    VERSION = 1
+
+    def __init__(self, block_number: int, gas_price: int, block_time: float, block_gas_limit: int, concurrency: int):
+        assert isinstance(block_number, int)
+        assert isinstance(gas_price, int)
+        assert isinstance(block_gas_limit, int)
+        assert isinstance(concurrency, int)
+
+        self.block_number = block_number
+        self.gas_price = gas_price
+        self.block_time = block_time
+        self.block_gas_limit = block_gas_limit
+        self.concurrency = concurrency
+        self.stages = {stage: {"count": 0, "estimated": 0, "gas": 0} for stage in STAGES}
+        self.ilks = {}
+
+    def add(self, stage: str, kind: str, ilk_name: Optional[str], estimates: List[Optional[int]]):
+        """ Adds actions of one kind, given the gas estimate of each or None where it could not be estimated """
+        assert stage in STAGES
+        assert kind in FALLBACK_GAS
+
+        gas = sum(FALLBACK_GAS[kind] if estimate is None else estimate for estimate in estimates)
+
+        self.stages[stage]["count"] += len(estimates)
+        self.stages[stage]["estimated"] += sum(1 for estimate in estimates if estimate is not None)
+        self.stages[stage]["gas"] += gas
+
+        if ilk_name is not None:
+            ilk = self.ilks.setdefault(ilk_name, {"gas": 0})
+            ilk[kind] = ilk.get(kind, 0) + len(estimates)
+            ilk["gas"] += gas
+
+    def blocks(self, stage: str) -> int:
+        count = self.stages[stage]["count"]
+        gas = self.stages[stage]["gas"]
+        return max(math.ceil(count / self.concurrency), math.ceil(gas / self.block_gas_limit))
+
+    def to_dict(self) -> dict:
+        stages = [{"name": stage, **self.stages[stage], "blocks": self.blocks(stage),
+                   "seconds": self.blocks(stage) * self.block_time} for stage in STAGES]
+        total_gas = sum(stage["gas"] for stage in stages)
+
+        return {
+            "version": ShutdownPlan.VERSION,
+            "block": self.block_number,
+            "gasPrice": self.gas_price,
+            "blockTime": self.block_time,
+            "blockGasLimit": self.block_gas_limit,
+            "concurrency": self.concurrency,
+            "ilks": self.ilks,
+            "stages": stages,
+            "totalGas": total_gas,
+            "projectedCostEth": total_gas * self.gas_price / 10**18,
+            "estimatedSeconds": sum(stage["seconds"] for stage in stages)
+        }
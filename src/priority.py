@@ -0,0 +1,84 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import time
+from typing import Any, Iterator, List, Optional, Tuple
+
+from src.underwater import RAY
+
+
+def skim_value(ink: int, art: int, rate: int, spot: int, mat: int) -> int:
+    """ Debt (`art * rate`) plus collateral value (`ink * spot * mat`) an `End.skim` resolves, as a raw `Rad` """
+    return art * rate + ink * spot * mat // RAY
+
+
+def skip_value(tab: int, lot: int, spot: int, mat: int) -> int:
+    """ Debt (`tab`) plus collateral value (`lot * spot * mat`) an `End.skip` returns to its urn, as a raw `Rad` """
+    return tab + lot * spot * mat // RAY
+
+
+def rank(candidates: List[Any], values: List[int], gas: List[Optional[int]],
+         fallback_gas: int) -> List[Tuple[Any, int, int]]:
+    """ Orders candidates by value per unit of gas, highest first, as `(candidate, value, gas)` tuples.
+
+    Candidates whose gas could not be estimated are assumed to use `fallback_gas`.
+    """
+    assert len(candidates) == len(values) == len(gas)
+
+    ranked = [(candidate, value, estimate or fallback_gas) for candidate, value, estimate in zip(candidates, values, gas)]
+    return sorted(ranked, key=lambda item: item[1] / item[2], reverse=True)
+
+
+class Budget:
+    """Optional caps on the ETH spent on, and the time taken by, prioritized transactions.
+
+    Spend is projected as estimated gas times `gas_price` when a transaction is admitted, so the cap holds
+    before any receipt is in. `max_spend` is in wei, `deadline` is a unix timestamp.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, gas_price: int, max_spend: Optional[int] = None, deadline: Optional[float] = None):
+        assert isinstance(gas_price, int)
+
+        self.gas_price = gas_price
+        self.max_spend = max_spend
+        self.deadline = deadline
+        self.spent = 0
+
+    def admit(self, gas: int) -> bool:
+        """ Charges the projected cost of a transaction, unless that would break a cap """
+        if self.deadline is not None and time.time() > self.deadline:
+            return False
+
+        cost = gas * self.gas_price
+        if self.max_spend is not None and self.spent + cost > self.max_spend:
+            return False
+
+        self.spent += cost
+        return True
+
+    def take(self, kind: str, ranked: List[Tuple[Any, int, int]]) -> Iterator[Any]:
+        """ Yields ranked candidates for as long as the budget admits them, logging what had to be left out """
+        for index, (candidate, value, gas) in enumerate(ranked):
+            if not self.admit(gas):
+                remaining = ranked[index:]
+                self.logger.warning(f"Budget exhausted: not sending {len(remaining)} {kind} transactions resolving "
+                                    f"{sum(item[1] for item in remaining) / 10**45:.2f} Dai of debt and collateral")
+                return
+            yield candidate
@@ -0,0 +1,245 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, List, Optional
+
+from requests.exceptions import ConnectionError, Timeout
+from web3 import HTTPProvider
+from web3.providers.base import BaseProvider
+
+from src.batch import post_batch
+
+# Methods whose result depends on state held by one particular node: our own transactions, nonces and filters
+PRIMARY_METHODS = {'eth_sendRawTransaction', 'eth_sendTransaction', 'eth_getTransactionCount', 'parity_nextNonce',
+                   'eth_getTransactionReceipt', 'eth_getTransactionByHash', 'eth_newFilter', 'eth_newBlockFilter',
+                   'eth_newPendingTransactionFilter', 'eth_getFilterChanges', 'eth_getFilterLogs',
+                   'eth_uninstallFilter'}
+
+# Error responses which say nothing about the request, only that the node (or the gateway in front of it) failed
+UNAVAILABLE_ERRORS = ['no response', 'no available upstream', 'timeout', 'timed out', 'too many requests',
+                      'rate limit', 'capacity exceeded', 'header not found', 'internal server error']
+
+
+class Endpoint:
+    def __init__(self, provider: HTTPProvider):
+        self.provider = provider
+        self.uri = provider.endpoint_uri
+        self.latency: Optional[float] = None
+        self.started: List[float] = []
+        self.failures = 0
+        self.ejected_until = 0.0
+
+    def healthy(self, now: float) -> bool:
+        return now >= self.ejected_until
+
+    def score(self, now: float) -> float:
+        # A request outstanding for longer than the usual latency is a better estimate of it, which also keeps nodes
+        # that have not answered yet from ranking first for ever
+        latency = max([self.latency or 0.0] + [now - start for start in self.started])
+        return latency * (1 + len(self.started))
+
+
+class EndpointUnavailable(Exception):
+    def __init__(self, endpoint: Endpoint, response: Optional[dict] = None, cause: Optional[Exception] = None):
+        super().__init__(f"{endpoint.uri} unavailable: {cause if cause else response.get('error')}")
+        self.response = response
+        self.cause = cause
+
+
+class RpcPool(BaseProvider):
+    """Spreads JSON-RPC requests across several nodes, routing around slow and failing ones.
+
+    Reads go to the healthy node with the lowest latency, weighted by the requests it already has in flight, so
+    concurrent log and auction scans spread across all nodes. A read which has not been answered after `hedge_after`
+    seconds is also sent to the next node, and whichever answers first wins. Transactions, nonces, receipts and
+    filters always go to the primary: the first healthy node in the order given. As consecutive reads may be served
+    by different nodes, log scans stop at `lowest_head()`, which every healthy node has reached.
+
+    A node which fails, or answers that it is unavailable, is ejected for `backoff` seconds, doubling with each
+    consecutive failure up to `max_backoff`, and the request is retried on the next node. If every node is ejected,
+    the one due back soonest is still tried rather than failing outright.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, providers: List[HTTPProvider], hedge_after: float = 1.0, backoff: float = 1.0,
+                 max_backoff: float = 60.0, max_workers: int = 100):
+        assert len(providers) > 0
+        assert all(isinstance(provider, HTTPProvider) for provider in providers)
+        assert hedge_after >= 0
+
+        self.endpoints = [Endpoint(provider) for provider in providers]
+        self.hedge_after = hedge_after
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __str__(self):
+        return f"RPC pool of {', '.join(endpoint.uri for endpoint in self.endpoints)}"
+
+    def isConnected(self) -> bool:
+        return any(endpoint.provider.isConnected() for endpoint in self.endpoints)
+
+    def make_request(self, method, params) -> dict:
+        send = lambda endpoint: endpoint.provider.make_request(method, params)
+
+        if method in PRIMARY_METHODS or 'pending' in params:
+            return self._failover(self._by_primary(), send)
+        return self._hedged(self._by_latency(), send)
+
+    def make_batch_request(self, payload: List[dict]) -> List[dict]:
+        """ Sends a JSON-RPC batch to a single node, chosen as for a single request """
+        send = lambda endpoint: post_batch(endpoint.provider, payload)
+
+        if any(item['method'] in PRIMARY_METHODS or 'pending' in item['params'] for item in payload):
+            return self._failover(self._by_primary(), send)
+        return self._hedged(self._by_latency(), send)
+
+    def lowest_head(self) -> int:
+        """ Returns the lowest block number among the healthy nodes, asking them all at once """
+        now = time.time()
+        with self.lock:
+            healthy = [endpoint for endpoint in self.endpoints if endpoint.healthy(now)]
+
+        send = lambda endpoint: endpoint.provider.make_request('eth_blockNumber', [])
+        futures = [self.executor.submit(self._attempt, endpoint, send) for endpoint in healthy]
+
+        heads = []
+        for future in futures:
+            try:
+                response = future.result()
+            except EndpointUnavailable:
+                continue
+            if 'result' in response:
+                heads.append(int(response['result'], 16))
+
+        if not heads:
+            # No node answered, so fall back to the node due back soonest as any other read would
+            response = self._hedged(self._by_latency(), send)
+            if 'error' in response:
+                raise ValueError(response['error'])
+            heads.append(int(response['result'], 16))
+
+        return min(heads)
+
+    def _by_primary(self) -> List[Endpoint]:
+        now = time.time()
+        with self.lock:
+            return sorted(self.endpoints, key=lambda endpoint: 0 if endpoint.healthy(now) else endpoint.ejected_until)
+
+    def _by_latency(self) -> List[Endpoint]:
+        now, clock = time.time(), time.perf_counter()
+        with self.lock:
+            healthy = sorted([endpoint for endpoint in self.endpoints if endpoint.healthy(now)],
+                             key=lambda endpoint: endpoint.score(clock))
+            ejected = sorted([endpoint for endpoint in self.endpoints if not endpoint.healthy(now)],
+                             key=lambda endpoint: endpoint.ejected_until)
+        return healthy + ejected
+
+    def _failover(self, endpoints: List[Endpoint], send: Callable):
+        error = None
+        for endpoint in endpoints:
+            try:
+                return self._attempt(endpoint, send)
+            except EndpointUnavailable as e:
+                error = e
+
+        return self._give_up(error)
+
+    def _hedged(self, endpoints: List[Endpoint], send: Callable):
+        remaining = iter(endpoints)
+        pending = {self.executor.submit(self._attempt, next(remaining), send)}
+        error = None
+
+        while pending:
+            done, pending = wait(pending, timeout=self.hedge_after or None, return_when=FIRST_COMPLETED)
+
+            for future in done:
+                try:
+                    return future.result()
+                except EndpointUnavailable as e:
+                    error = e
+
+            # Either the request failed, so fail over, or it is slow, so hedge; the slower answer is discarded
+            endpoint = next(remaining, None)
+            if endpoint is not None:
+                if not done:
+                    self.logger.debug(f"Hedging request to {endpoint.uri}")
+                pending.add(self.executor.submit(self._attempt, endpoint, send))
+
+        return self._give_up(error)
+
+    def _give_up(self, error: EndpointUnavailable):
+        # Hand back the node's own error response, so that callers see the same error a single node would give
+        if error.response is not None:
+            return error.response
+        raise error.cause
+
+    def _attempt(self, endpoint: Endpoint, send: Callable):
+        start = time.perf_counter()
+        with self.lock:
+            endpoint.started.append(start)
+
+        try:
+            response = send(endpoint)
+        except Exception as e:
+            self._failed(endpoint, EndpointUnavailable(endpoint, cause=e))
+        else:
+            responses = response if isinstance(response, list) else [response]
+            if any(_unavailable(item) for item in responses):
+                self._failed(endpoint, EndpointUnavailable(endpoint, response=response))
+
+            self._succeeded(endpoint, time.perf_counter() - start)
+            return response
+        finally:
+            with self.lock:
+                endpoint.started.remove(start)
+
+    def _succeeded(self, endpoint: Endpoint, seconds: float):
+        with self.lock:
+            endpoint.latency = seconds if endpoint.latency is None else 0.8 * endpoint.latency + 0.2 * seconds
+            if endpoint.failures > 0:
+                self.logger.info(f"RPC endpoint {endpoint.uri} has recovered")
+            endpoint.failures = 0
+
+    def _failed(self, endpoint: Endpoint, error: EndpointUnavailable):
+        with self.lock:
+            endpoint.failures += 1
+            delay = min(self.backoff * 2 ** (endpoint.failures - 1), self.max_backoff)
+            endpoint.ejected_until = time.time() + delay
+
+        self.logger.warning(f"{error}; ejecting it for {delay:.1f}s")
+        raise error
+
+
+def unavailable(error: Exception) -> bool:
+    """ Returns whether `error` only says that the node, or the gateway in front of it, could not serve a request """
+    if isinstance(error, (ConnectionError, Timeout)):
+        return True
+    return isinstance(error, ValueError) and any(reason in str(error).lower() for reason in UNAVAILABLE_ERRORS)
+
+
+def _unavailable(response: dict) -> bool:
+    if not isinstance(response, dict) or 'error' not in response:
+        return False
+    message = str(response['error'].get('message', '') if isinstance(response['error'], dict) else response['error'])
+    return any(reason in message.lower() for reason in UNAVAILABLE_ERRORS)
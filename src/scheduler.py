@@ -0,0 +1,80 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+
+class Scheduler:
+    """Runs named tasks at a unix timestamp on a single background thread.
+
+    A task is pending from the moment it is scheduled until its callback has returned, which lets callers
+    stay dormant (e.g. skip per-block work) while a deadline is still far away.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self):
+        self.tasks: Dict[str, Tuple[float, Callable[[], None]]] = {}
+        self.running: Optional[str] = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='scheduler', daemon=True)
+        self.thread.start()
+
+    def schedule(self, name: str, at: float, callback: Callable[[], None]):
+        """ Schedules `callback` to run at unix time `at`, replacing any pending task with the same name """
+        assert isinstance(name, str)
+        assert callable(callback)
+
+        with self.condition:
+            self.tasks[name] = (at, callback)
+            self.condition.notify()
+
+    def cancel(self, name: str):
+        with self.condition:
+            self.tasks.pop(name, None)
+            self.condition.notify()
+
+    def is_pending(self, name: str) -> bool:
+        with self.condition:
+            return name in self.tasks or self.running == name
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.tasks:
+                    self.condition.wait()
+
+                name, (at, callback) = min(self.tasks.items(), key=lambda item: item[1][0])
+                delay = at - time.time()
+                if delay > 0:
+                    # Woken early whenever tasks change, so the earliest deadline is always the one waited for
+                    self.condition.wait(delay)
+                    continue
+
+                del self.tasks[name]
+                self.running = name
+
+            try:
+                callback()
+            except Exception as e:
+                self.logger.warning(f"Error in scheduled task {name}: {str(e)}")
+            finally:
+                with self.condition:
+                    self.running = None
@@ -0,0 +1,104 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import logging
+import threading
+import time
+from typing import Dict, List, Optional
+
+from web3 import Web3
+
+from pymaker import Address
+from pymaker.numeric import Wad
+
+from src.batch import BatchCaller
+
+
+class SenderPool:
+    """Spreads independent transactions across several funded accounts, so they are not limited to one nonce stream.
+
+    Each transaction goes to the funded account with the fewest transactions in flight; pymaker allocates the nonces
+    of every account independently. `TransactionPipeline` re-reads balances off its event loop once they are older than
+    `refresh_seconds`, and an account whose balance falls below `min_balance` stops receiving transactions. If no
+    account is funded, `primary` is used.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, web3: Web3, batch: BatchCaller, primary: Address, accounts: List[Address],
+                 min_balance: Wad, refresh_seconds: float = 30.0):
+        assert isinstance(web3, Web3)
+        assert isinstance(batch, BatchCaller)
+        assert isinstance(primary, Address)
+        assert isinstance(min_balance, Wad)
+
+        self.web3 = web3
+        self.batch = batch
+        self.primary = primary
+        self.accounts = [primary] + [account for account in accounts if account != primary]
+        self.min_balance = min_balance
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.in_flight: Dict[Address, int] = {account: 0 for account in self.accounts}
+        self.sent: Dict[Address, int] = {account: 0 for account in self.accounts}
+        self.funded: List[Address] = list(self.accounts)
+        self.refreshed = 0.0
+
+    def __len__(self):
+        return max(len(self.funded), 1)
+
+    def refresh(self):
+        """ Re-reads every account's balance in a single batch, dropping those which can no longer pay for gas """
+        responses = self.batch.request([("eth_getBalance", [account.address, "latest"]) for account in self.accounts])
+        balances = {account: Wad(int(response['result'], 16)) if 'result' in response else Wad(0)
+                    for account, response in zip(self.accounts, responses)}
+
+        with self.lock:
+            funded = [account for account in self.accounts if balances[account] >= self.min_balance]
+            for account in set(self.funded) - set(funded):
+                self.logger.warning(f"Sender {account} is down to {balances[account]} ETH, no longer using it")
+            self.funded = funded
+            self.refreshed = time.time()
+
+    def stale(self) -> bool:
+        return time.time() - self.refreshed > self.refresh_seconds
+
+    def acquire(self) -> Address:
+        """ Picks the account to send the next transaction from; balances are only re-read by `refresh` """
+        with self.lock:
+            candidates = self.funded or [self.primary]
+            account = min(candidates, key=lambda account: self.in_flight[account])
+            self.in_flight[account] += 1
+            self.sent[account] += 1
+            return account
+
+    def release(self, account: Address):
+        with self.lock:
+            self.in_flight[account] -= 1
+
+
+def key_addresses(eth_keys: Optional[List[str]]) -> List[Address]:
+    """ Addresses of the keystore files given to `--eth-key`, e.g. 'key_file=/path/key.json,pass_file=/path/pass' """
+    addresses = []
+    for eth_key in eth_keys or []:
+        options = dict(option.split('=', 1) for option in eth_key.split(',') if '=' in option)
+        if 'key_file' in options:
+            with open(options['key_file']) as key_file:
+                addresses.append(Address('0x' + json.load(key_file)['address'].replace('0x', '')))
+
+    return addresses
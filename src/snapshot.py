@@ -0,0 +1,161 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import mmap
+import os
+import struct
+from typing import Dict, Iterator, List, Optional, TYPE_CHECKING
+
+from web3 import Web3
+
+from pymaker import Address
+from pymaker.dss import Ilk, Urn
+
+from src.batch import BatchCaller
+from src.log_scanner import LogScanner
+from src.urn_index import FORK_TOPIC, FROB_TOPIC, IndexedUrnHistoryProvider, UrnIndex
+from src.urn_table import ADDRESS, WORD, UrnTable
+
+if TYPE_CHECKING:
+    from pymaker.deployment import DssDeployment
+
+SNAPSHOT_MAGIC = b'CAGESNAP'
+SNAPSHOT_VERSION = 1
+
+# magic, version, block, End address, number of ilks, number of auction contracts
+HEADER = struct.Struct('<8sHQ20sII')
+# ilk name, offset of its columns, number of urns
+ILK_ENTRY = struct.Struct('<32sQQ')
+# auction contract, offset of its ids, number of open auctions
+AUCTION_ENTRY = struct.Struct('<20sQQ')
+AUCTION_ID = struct.Struct('<Q')
+
+# Besides frob and fork, the Vat changes an urn's ink and art through grab (bite, skim)
+GRAB_TOPIC = '0x' + Web3.keccak(text="grab(bytes32,address,address,address,int256,int256)")[:4].hex()[2:].ljust(64, '0')
+
+
+def write_snapshot(path: str, block: int, end: Address, urns: Dict[str, UrnTable], auctions: Dict[str, List[int]]):
+    """ Writes the urns of each ilk and the open auction ids of each contract, as they were at `block`.
+
+    The columns of each table are written as they are, without first being copied into one buffer. The file is
+    written next to `path` and then renamed over it, so keepers which have the previous snapshot mapped keep reading
+    a complete file.
+    """
+    assert isinstance(block, int)
+    assert isinstance(end, Address)
+    assert all(isinstance(table, UrnTable) for table in urns.values())
+
+    ilk_names = sorted(urns.keys())
+    contracts = sorted(auctions.keys())
+    ids = {contract: sorted(auctions[contract]) for contract in contracts}
+    offset = HEADER.size + len(ilk_names) * ILK_ENTRY.size + len(contracts) * AUCTION_ENTRY.size
+
+    directory = []
+    for name in ilk_names:
+        directory.append(ILK_ENTRY.pack(name.encode('utf-8'), offset, len(urns[name])))
+        offset += len(urns[name]) * (ADDRESS + 2 * WORD)
+    for contract in contracts:
+        directory.append(AUCTION_ENTRY.pack(bytes.fromhex(contract[2:]), offset, len(ids[contract])))
+        offset += len(ids[contract]) * AUCTION_ID.size
+
+    temporary = f"{path}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, block, bytes.fromhex(end.address[2:]),
+                               len(ilk_names), len(contracts)))
+        file.writelines(directory)
+        for name in ilk_names:
+            file.writelines([urns[name].addresses, urns[name].inks, urns[name].arts])
+        for contract in contracts:
+            file.writelines(AUCTION_ID.pack(id) for id in ids[contract])
+    os.replace(temporary, path)
+
+
+class Snapshot:
+    """Urns and open auctions read from a snapshot file, valid as of `block`.
+
+    Urn columns are laid out as in an `UrnTable`, so the tables handed out by `urns` read straight from the buffer;
+    with `open`, that is a read-only memory map, and only the pages of urns actually read are loaded.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer)
+        if len(self.buffer) < HEADER.size:
+            raise ValueError("Not a cage-keeper snapshot")
+
+        magic, version, self.block, end, ilk_count, contract_count = HEADER.unpack_from(self.buffer, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError("Not a cage-keeper snapshot")
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {version}, expected {SNAPSHOT_VERSION}")
+        self.end = Address('0x' + end.hex())
+
+        position = HEADER.size
+        self.ilks = {}
+        for _ in range(ilk_count):
+            name, offset, count = ILK_ENTRY.unpack_from(self.buffer, position)
+            self.ilks[name.rstrip(b'\0').decode('utf-8')] = (offset, count)
+            position += ILK_ENTRY.size
+
+        self.auctions = {}
+        for _ in range(contract_count):
+            contract, offset, count = AUCTION_ENTRY.unpack_from(self.buffer, position)
+            self.auctions[Address('0x' + contract.hex()).address] = (offset, count)
+            position += AUCTION_ENTRY.size
+
+    @classmethod
+    def open(cls, path: str) -> 'Snapshot':
+        with open(path, "rb") as file:
+            return cls(mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def urns(self, ilk: Ilk) -> UrnTable:
+        """ Returns the urns of the ilk as they were at `block`, without copying them out of the buffer """
+        offset, count = self.ilks.get(ilk.name, (0, 0))
+        addresses = self.buffer[offset:offset + count * ADDRESS]
+        inks = self.buffer[offset + count * ADDRESS:offset + count * (ADDRESS + WORD)]
+        arts = self.buffer[offset + count * (ADDRESS + WORD):offset + count * (ADDRESS + 2 * WORD)]
+        return UrnTable.from_columns(ilk, addresses, inks, arts)
+
+    def auction_ids(self, contract: str) -> List[int]:
+        offset, count = self.auctions.get(contract, (0, 0))
+        return [AUCTION_ID.unpack_from(self.buffer, offset + index * AUCTION_ID.size)[0] for index in range(count)]
+
+
+class SnapshotUrnHistoryProvider(IndexedUrnHistoryProvider):
+    """Urns of an ilk as recorded in a `Snapshot`, with only the urns changed since its block read from the Vat.
+
+    `index` records every urn frobbed, grabbed or forked after the snapshot's block; it must hold nothing else.
+    """
+
+    topics = [FROB_TOPIC, GRAB_TOPIC, FORK_TOPIC]
+
+    def __init__(self, web3: Web3, mcd: 'DssDeployment', ilk: Ilk, snapshot: Snapshot, index: UrnIndex,
+                 scanner: Optional[LogScanner] = None, lookback: int = 12, batch: Optional[BatchCaller] = None):
+        assert isinstance(snapshot, Snapshot)
+        super().__init__(web3, mcd, ilk, snapshot.block + 1, index, scanner, lookback, batch)
+
+        self.snapshot = snapshot
+
+    def iter_urns(self) -> Iterator[Urn]:
+        self.sync()
+
+        changed = self.index.addresses(self.ilk.name)
+        changed_addresses = set(address.address for address in changed)
+        for urn in self.snapshot.urns(self.ilk):
+            if urn.address.address not in changed_addresses:
+                yield urn
+
+        yield from self.read_urns(changed)
@@ -0,0 +1,58 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from typing import Callable
+
+
+class WarmStandby:
+    """Runs `refresh` on a background thread whenever `notify` is called, skipping notifications which arrive
+    while a refresh is already running, so that block processing is never held up by it."""
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, refresh: Callable[[], None]):
+        assert callable(refresh)
+
+        self.refresh = refresh
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='warm-standby', daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        self.wakeup.set()
+
+    def stop(self):
+        """ Stops refreshing, waiting for a refresh in progress to finish """
+        self.stopped.set()
+        self.wakeup.set()
+        self.thread.join()
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+
+            if self.stopped.is_set():
+                break
+
+            try:
+                self.refresh()
+            except Exception as e:
+                self.logger.warning(f"Error refreshing warm standby state: {str(e)}")
@@ -0,0 +1,61 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from typing import List, TYPE_CHECKING
+
+from pymaker.dss import Ilk
+from pymaker.numeric import Rad
+
+from src.batch import BatchCaller
+
+if TYPE_CHECKING:
+    from pymaker.deployment import DssDeployment
+
+
+class ThawState:
+    """What is left to do to thaw the cage: Dai to heal in the Vow, whether `End.thaw` has been called, and the ilks
+    with debt whose fix has not been set by `End.flow` yet"""
+
+    def __init__(self, dai: Rad, debt: Rad, ilks: List[Ilk], unflowed: List[Ilk]):
+        self.dai = dai
+        self.debt = debt
+        self.ilks = ilks
+        self.unflowed = unflowed
+
+    @property
+    def thawed(self) -> bool:
+        return self.debt > Rad(0)
+
+    @staticmethod
+    def read(batch: BatchCaller, mcd: 'DssDeployment') -> 'ThawState':
+        """ Reads Vow Dai, `End.debt`, and `Vat.ilks(ilk).Art` and `End.fix(ilk)` of every ilk in a single batch """
+        assert isinstance(batch, BatchCaller)
+
+        ilks = [collateral.ilk for collateral in mcd.collaterals.values() if collateral.ilk.name != 'SAI']
+
+        calls = [(mcd.vat, 'dai', [mcd.vow.address.address]), (mcd.end, 'debt', [])]
+        for ilk in ilks:
+            calls += [(mcd.vat, 'ilks', [ilk.toBytes()]), (mcd.end, 'fix', [ilk.toBytes()])]
+        results = batch.read(calls)
+
+        # Vat.ilks returns Art first, End.fix a single ray
+        arts = [results[2 + 2 * index][0] for index in range(len(ilks))]
+        fixes = [results[3 + 2 * index][0] for index in range(len(ilks))]
+        ilks_with_debt = [ilk for ilk, art in zip(ilks, arts) if art > 0]
+        unflowed = [ilk for ilk, art, fix in zip(ilks, arts, fixes) if art > 0 and fix == 0]
+
+        return ThawState(Rad(results[0][0]), Rad(results[1][0]), ilks_with_debt, unflowed)
@@ -0,0 +1,113 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional, Tuple, Union
+
+from pymaker import Receipt, Transact
+from pymaker.gas import GasPrice
+from pymaker.util import synchronize
+
+from src.senders import SenderPool
+
+
+class TransactionPipeline:
+    """Submits independent transactions, keeping up to `max_pending` of them in flight at once.
+
+    Nonces are allocated by pymaker under its transaction lock at the moment each transaction is
+    broadcast, so transactions which fail gas estimation never leave a gap in the nonce sequence.
+    Receipts are awaited concurrently; `execute_stream` only returns once every transaction has been mined
+    or has failed, which lets callers order dependent stages (e.g. `End.cage` before `End.skim`).
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, gas_price: GasPrice, max_pending: int = 10):
+        assert isinstance(gas_price, GasPrice)
+        assert isinstance(max_pending, int)
+        assert max_pending > 0
+
+        self.gas_price = gas_price
+        self.max_pending = max_pending
+
+    def execute_stream(self, transactions: Iterable[Tuple[Transact, Any]],
+                       on_result: Callable[[Any, Union[Receipt, None, Exception]], None],
+                       on_submit: Optional[Callable[[Any], None]] = None,
+                       senders: Optional[SenderPool] = None) -> int:
+        """ Sends `(transaction, tag)` pairs as they are produced, calling `on_result(tag, receipt_or_exception)`.
+
+        The iterable is advanced on a separate thread, so a producer which is still fetching data never holds up
+        receipts, and it is only advanced while fewer than `max_pending` transactions are in flight.
+        `on_submit(tag)`, if given, is called just before each transaction is sent.
+        With `senders`, each transaction is sent from one of its accounts, and `max_pending` applies per account.
+        Returns the number of transactions sent.
+        """
+        if senders:
+            senders.refresh()
+
+        return synchronize([self._execute_stream(iter(transactions), on_result, on_submit, senders)])[0]
+
+    async def _execute_stream(self, transactions: Iterator[Tuple[Transact, Any]], on_result: Callable,
+                              on_submit: Optional[Callable], senders: Optional[SenderPool]) -> int:
+        loop = asyncio.get_event_loop()
+        # Created here so that the semaphore is bound to the loop running this stage
+        semaphore = asyncio.Semaphore(self.max_pending * (len(senders) if senders else 1))
+        pending = set()
+        count = 0
+
+        try:
+            with ThreadPoolExecutor(max_workers=1) as producer:
+                while True:
+                    await semaphore.acquire()
+                    # Balances are read over HTTP, so stale ones are refreshed on the producer thread, not this loop
+                    if senders and senders.stale():
+                        await loop.run_in_executor(producer, senders.refresh)
+                    item = await loop.run_in_executor(producer, next, transactions, None)
+                    if item is None:
+                        break
+
+                    transact, tag = item
+                    if on_submit:
+                        on_submit(tag)
+                    task = asyncio.ensure_future(self._execute(semaphore, transact, tag, on_result, senders))
+                    pending.add(task)
+                    task.add_done_callback(pending.discard)
+                    count += 1
+        finally:
+            if pending:
+                await asyncio.gather(*list(pending))
+
+        return count
+
+    async def _execute(self, semaphore: asyncio.Semaphore, transact: Transact, tag, on_result: Callable,
+                       senders: Optional[SenderPool]):
+        sender = senders.acquire() if senders else None
+        try:
+            if sender:
+                result = await transact.transact_async(gas_price=self.gas_price, from_address=sender)
+            else:
+                result = await transact.transact_async(gas_price=self.gas_price)
+        except Exception as e:
+            result = e
+        finally:
+            if sender:
+                senders.release(sender)
+            semaphore.release()
+
+        on_result(tag, result)
@@ -0,0 +1,29 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+WAD_TO_RAY = 10**9
+RAY = 10**27
+
+
+def is_underwater(ink: int, art: int, rate: int, spot: int, mat: int) -> bool:
+    """ Evaluates `art * rate > ink * spot * mat` for raw `ink`/`art` (`Wad`) and `rate`/`spot`/`mat` (`Ray`) values.
+
+    Products are floored after every multiplication, exactly as pymaker's `Ray.__mul__` does, so the result
+    matches comparing `Ray` objects.
+    """
+    return (art * WAD_TO_RAY * rate) // RAY > ((ink * WAD_TO_RAY * spot) // RAY * mat) // RAY
+
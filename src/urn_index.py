@@ -0,0 +1,182 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+import sqlite3
+import threading
+from typing import Iterable, Iterator, List, Optional, TYPE_CHECKING
+
+from hexbytes import HexBytes
+from web3 import Web3
+
+from pymaker import Address
+from pymaker.dss import Ilk, Urn
+from pymaker.numeric import Wad
+
+from src.batch import BatchCaller
+from src.log_scanner import LogScanner
+
+if TYPE_CHECKING:
+    from pymaker.deployment import DssDeployment
+
+FROB_TOPIC = '0x' + Web3.keccak(text="frob(bytes32,address,address,address,int256,int256)")[:4].hex()[2:].ljust(64, '0')
+FORK_TOPIC = '0x' + Web3.keccak(text="fork(bytes32,address,address,int256,int256)")[:4].hex()[2:].ljust(64, '0')
+
+
+def topic_address(topic) -> Address:
+    return Address('0x' + bytes(HexBytes(topic))[-20:].hex())
+
+
+class UrnIndex:
+    """SQLite file recording, per ilk, the address of every urn ever frobbed and the last block synced.
+
+    The file also records the Vat and chain its urns were read from, see `bind`.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, path: str):
+        assert isinstance(path, str)
+
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.bound = False
+
+        with self.lock, self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS urns (ilk TEXT NOT NULL, address TEXT NOT NULL, "
+                            "PRIMARY KEY (ilk, address))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS synced (ilk TEXT PRIMARY KEY, block INTEGER NOT NULL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS deployment (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def bind(self, vat: Address, chain_id: int):
+        """ Ties the index to a Vat, clearing it first if it holds urns of another Vat or chain, or of an unknown one """
+        assert isinstance(vat, Address)
+        assert isinstance(chain_id, int)
+
+        expected = {'vat': vat.address, 'chain_id': str(chain_id)}
+        with self.lock, self.db:
+            recorded = dict(self.db.execute("SELECT key, value FROM deployment").fetchall())
+            if recorded != expected:
+                if recorded or self.db.execute("SELECT 1 FROM synced LIMIT 1").fetchone():
+                    self.logger.warning(f"Urn index {self.path} was not synced from Vat {vat} on chain {chain_id}, "
+                                        f"clearing it")
+                self.db.execute("DELETE FROM urns")
+                self.db.execute("DELETE FROM synced")
+                self.db.execute("DELETE FROM deployment")
+                self.db.executemany("INSERT INTO deployment (key, value) VALUES (?, ?)", expected.items())
+            self.bound = True
+
+    def last_block(self, ilk_name: str) -> Optional[int]:
+        """ Returns the last block whose frobs have been recorded for the ilk, if it was ever synced """
+        with self.lock:
+            row = self.db.execute("SELECT block FROM synced WHERE ilk = ?", (ilk_name,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, ilk_name: str, addresses: Iterable[Address], block: int):
+        """ Records urn addresses and advances the synced block for the ilk in a single transaction """
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR IGNORE INTO urns (ilk, address) VALUES (?, ?)",
+                                [(ilk_name, address.address) for address in addresses])
+            self.db.execute("INSERT OR REPLACE INTO synced (ilk, block) VALUES (?, ?)", (ilk_name, block))
+
+    def addresses(self, ilk_name: str) -> List[Address]:
+        with self.lock:
+            rows = self.db.execute("SELECT address FROM urns WHERE ilk = ?", (ilk_name,)).fetchall()
+        return [Address(row[0]) for row in rows]
+
+
+class IndexedUrnHistoryProvider:
+    """Yields the urns of an ilk from the Vat, like auction-keeper's `ChainUrnHistoryProvider`, but only fetches the
+    frobs the index has not seen.
+
+    Forks are indexed too, as urns moved with `Vat.fork` (e.g. by the CDP manager's enter, quit and shift) may
+    never have been frobbed themselves. Each sync re-reads `lookback` blocks below the last synced block so that
+    urns frobbed in a block which was later reorganized are still picked up; duplicates are ignored by the index.
+    Frob logs are fetched by a `LogScanner`, which may be shared between ilks so each starts from the range size the
+    node sustained last.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    # Vat.frob and Vat.fork are noted with the ilk and the urn as their first two indexed arguments, fork with the
+    # urn it moves to as the third
+    topics = [FROB_TOPIC, FORK_TOPIC]
+
+    def __init__(self, web3: Web3, mcd: 'DssDeployment', ilk: Ilk, from_block: int, index: UrnIndex,
+                 scanner: Optional[LogScanner] = None, lookback: int = 12, batch: Optional[BatchCaller] = None):
+        assert isinstance(web3, Web3)
+        assert isinstance(ilk, Ilk)
+        assert isinstance(from_block, int)
+        assert isinstance(index, UrnIndex)
+        assert isinstance(scanner, LogScanner) or scanner is None
+        assert isinstance(batch, BatchCaller) or batch is None
+
+        if not index.bound:
+            index.bind(mcd.vat.address, int(web3.eth.chainId))
+
+        self.web3 = web3
+        self.mcd = mcd
+        self.ilk = ilk
+        self.from_block = from_block
+        self.index = index
+        self.scanner = scanner or LogScanner(web3)
+        self.lookback = lookback
+        self.batch = batch or BatchCaller(web3)
+
+    def sync(self) -> int:
+        """ Records frobs up to the current block, committing after each range so progress survives restarts """
+        last_block = self.index.last_block(self.ilk.name)
+        start = self.from_block if last_block is None else max(self.from_block, last_block - self.lookback)
+        to_block = self.scanner.head()
+
+        filter_params = {'address': self.mcd.vat.address.address,
+                         'topics': [self.topics, '0x' + self.ilk.toBytes().hex()]}
+
+        for window_start, window_end, logs in self.scanner.scan(filter_params, start, to_block):
+            urns = set(address for log in logs for address in self.urn_addresses(log))
+            self.index.add(self.ilk.name, urns, window_end)
+            self.logger.debug(f"Indexed {len(logs)} frobs of {self.ilk.name} from blocks {window_start}-{window_end}")
+
+        return to_block
+
+    def urn_addresses(self, log) -> List[Address]:
+        if HexBytes(log['topics'][0]).hex() == FORK_TOPIC:
+            return [topic_address(log['topics'][2]), topic_address(log['topics'][3])]
+
+        return [topic_address(log['topics'][2])]
+
+    def iter_urns(self) -> Iterator[Urn]:
+        """ Syncs the index, then yields the current state of each indexed urn as soon as it has been read """
+        self.sync()
+
+        yield from self.read_urns(self.index.addresses(self.ilk.name))
+
+    def read_urns(self, addresses: Iterable[Address]) -> Iterator[Urn]:
+        """ Yields the current state of each urn, reading `Vat.urns` for `batch_size` urns per round trip """
+        addresses = iter(addresses)
+
+        while True:
+            chunk = list(itertools.islice(addresses, self.batch.batch_size))
+            if not chunk:
+                break
+
+            results = self.batch.read([(self.mcd.vat, 'urns', [self.ilk.toBytes(), address.address])
+                                       for address in chunk])
+            for address, (ink, art) in zip(chunk, results):
+                yield Urn(address, self.ilk, Wad(ink), Wad(art))
@@ -0,0 +1,132 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from array import array
+from typing import Dict, Iterable, Iterator, List
+
+from pymaker import Address
+from pymaker.dss import Ilk, Urn
+from pymaker.numeric import Wad
+
+WORD = 32
+ADDRESS = 20
+
+
+class UrnTable:
+    """Append-only table of urns held as columns rather than as one `Urn` object per vault.
+
+    `ink` and `art` are stored as 32-byte words, matching their width in the Vat, and addresses as their 20 raw bytes;
+    each ilk is stored once and referenced by position. Indexing or iterating the table hands out `UrnView`s, which
+    read their fields from the columns only when accessed.
+    """
+
+    def __init__(self, urns: Iterable[Urn] = ()):
+        self.ilks: List[Ilk] = []
+        self.ilk_ids: Dict[str, int] = {}
+        self.ilk_column = array('H')
+        self.addresses = bytearray()
+        self.inks = bytearray()
+        self.arts = bytearray()
+
+        for urn in urns:
+            self.append(urn)
+
+    @classmethod
+    def from_columns(cls, ilk: Ilk, addresses, inks, arts) -> 'UrnTable':
+        """ Wraps existing columns of urns of a single ilk, e.g. views of a memory-mapped file, without copying them.
+
+        A table built over read-only buffers cannot be appended to.
+        """
+        assert isinstance(ilk, Ilk)
+        assert len(addresses) // ADDRESS == len(inks) // WORD == len(arts) // WORD
+
+        table = cls()
+        table.ilks.append(ilk)
+        table.ilk_ids[ilk.name] = 0
+        table.ilk_column = array('H', bytes(2 * (len(addresses) // ADDRESS)))
+        table.addresses = addresses
+        table.inks = inks
+        table.arts = arts
+        return table
+
+    def append(self, urn: Urn):
+        assert isinstance(urn.ilk, Ilk)
+        assert isinstance(urn.ink, Wad)
+        assert isinstance(urn.art, Wad)
+
+        # The first Ilk seen under a name is kept for every urn of that ilk
+        if urn.ilk.name not in self.ilk_ids:
+            self.ilk_ids[urn.ilk.name] = len(self.ilks)
+            self.ilks.append(urn.ilk)
+
+        self.ilk_column.append(self.ilk_ids[urn.ilk.name])
+        self.addresses += bytes.fromhex(urn.address.address[2:])
+        self.inks += urn.ink.value.to_bytes(WORD, 'big')
+        self.arts += urn.art.value.to_bytes(WORD, 'big')
+
+    def __len__(self) -> int:
+        return len(self.ilk_column)
+
+    def __getitem__(self, index: int) -> 'UrnView':
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("urn index out of range")
+
+        return UrnView(self, index)
+
+    def __iter__(self) -> Iterator['UrnView']:
+        for index in range(len(self)):
+            yield UrnView(self, index)
+
+    def address(self, index: int) -> Address:
+        return Address('0x' + self.addresses[index * ADDRESS:(index + 1) * ADDRESS].hex())
+
+    def ilk(self, index: int) -> Ilk:
+        return self.ilks[self.ilk_column[index]]
+
+    def ink(self, index: int) -> int:
+        return int.from_bytes(self.inks[index * WORD:(index + 1) * WORD], 'big')
+
+    def art(self, index: int) -> int:
+        return int.from_bytes(self.arts[index * WORD:(index + 1) * WORD], 'big')
+
+
+class UrnView(Urn):
+    """Read-only `Urn` backed by a row of an `UrnTable`"""
+
+    __slots__ = ('table', 'index')
+
+    def __init__(self, table: UrnTable, index: int):
+        self.table = table
+        self.index = index
+
+    @property
+    def address(self) -> Address:
+        return self.table.address(self.index)
+
+    @property
+    def ilk(self) -> Ilk:
+        return self.table.ilk(self.index)
+
+    @property
+    def ink(self) -> Wad:
+        return Wad(self.table.ink(self.index))
+
+    @property
+    def art(self) -> Wad:
+        return Wad(self.table.art(self.index))
@@ -0,0 +1,124 @@
+# This file is part of the Maker Keeper Framework.
+#
+# Copyright (C) 2019 EdNoepel, KentonPrescott
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import itertools
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Iterator, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from pymaker import Address
+from pymaker.dss import Ilk, Urn
+from pymaker.numeric import Wad
+
+# Pages are ordered by urn so that offsets stay stable between requests
+URNS_PAGE_QUERY = """query ($ilk: String, $first: Int, $offset: Int) {
+  allUrns(condition: {ilkIdentifier: $ilk}, orderBy: URN_IDENTIFIER_ASC, first: $first, offset: $offset) {
+    totalCount
+    nodes {
+      urnIdentifier
+      ink
+      art
+    }
+  }
+}"""
+
+
+def vulcanize_session(api_key: str, pool_size: int = 16) -> requests.Session:
+    """ A keep-alive session with gzip-compressed responses, shared by every page fetch """
+    session = requests.Session()
+    session.headers.update({'Authorization': f'Basic {api_key}', 'Accept-Encoding': 'gzip, deflate'})
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class PagedVulcanizeUrnHistoryProvider:
+    """Yields the urns of an ilk from Vulcanize, like auction-keeper's `VulcanizeUrnHistoryProvider`, but fetches
+    them in pages of `page_size`.
+
+    The first page reports how many urns the ilk has; up to `workers` further pages are then fetched at once, and
+    each page's urns are yielded as soon as it is decoded. A page which fails is retried up to `retries` times, with a
+    backoff doubling from `backoff` seconds, without fetching the other pages again.
+    """
+
+    logger = logging.getLogger('cage-keeper')
+
+    def __init__(self, ilk: Ilk, endpoint: str, session: requests.Session, page_size: int = 1000,
+                 workers: int = 4, retries: int = 3, backoff: float = 1.0, timeout: float = 60.0):
+        assert isinstance(ilk, Ilk)
+        assert isinstance(endpoint, str)
+        assert isinstance(session, requests.Session)
+        assert page_size > 0
+        assert workers > 0
+
+        self.ilk = ilk
+        self.endpoint = endpoint
+        self.session = session
+        self.page_size = page_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def iter_urns(self) -> Iterator[Urn]:
+        first = self.fetch_page(0)
+        yield from self.decode(first['nodes'])
+
+        offsets = iter(range(self.page_size, first['totalCount'], self.page_size))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = {executor.submit(self.fetch_page, offset) for offset in itertools.islice(offsets, self.workers)}
+            try:
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # Only keep `workers` pages in flight, so pages are not buffered faster than they are evaluated
+                        for offset in itertools.islice(offsets, 1):
+                            pending.add(executor.submit(self.fetch_page, offset))
+                        yield from self.decode(future.result()['nodes'])
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def fetch_page(self, offset: int) -> dict:
+        variables = {'ilk': self.ilk.name, 'first': self.page_size, 'offset': offset}
+
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(self.endpoint, json={'query': URNS_PAGE_QUERY, 'variables': variables},
+                                             timeout=self.timeout)
+                response.raise_for_status()
+                result = response.json()
+                if 'errors' in result:
+                    raise ValueError(result['errors'])
+
+                return result['data']['allUrns']
+            except (requests.RequestException, ValueError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = self.backoff * 2 ** attempt
+                self.logger.warning(f"Retrying page of {self.ilk.name} urns at offset {offset} in {delay:.1f}s "
+                                    f"after error: {e}")
+                time.sleep(delay)
+
+    def decode(self, nodes: List[dict]) -> Iterator[Urn]:
+        for node in nodes:
+            yield Urn(Address(node['urnIdentifier']), self.ilk, Wad(int(node['ink'])), Wad(int(node['art'])))
@@ -16,16 +16,34 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import pytest
+import requests
+import threading
+import types
 
 from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import time
 from typing import List
 import logging
 
-from web3 import Web3
+from web3 import Web3, HTTPProvider
 
+from src.batch import BatchCaller
 from src.cage_keeper import CageKeeper
+from src.cage_watcher import CageWatcher
+from src.journal import ActionJournal
+from src.log_scanner import LogScanner
+from src.rpc_pool import RpcPool
+from src.scheduler import Scheduler
+from src.senders import SenderPool, key_addresses
+from src.thaw import ThawState
+from src.priority import Budget, rank, skim_value
+from src.underwater import is_underwater
+from src.urn_index import UrnIndex
+from src.urn_table import UrnTable
+from src.vulcanize import PagedVulcanizeUrnHistoryProvider, vulcanize_session
 
 from pymaker import Address
 from pymaker.approval import directly, hope_directly
@@ -279,10 +297,125 @@ pytest.global_auctions = {}
 
 class TestCageKeeper:
 
+    def test_is_underwater(self):
+        print_out("test_is_underwater")
+
+        rate = Ray.from_number(1.05)
+        spot = Ray.from_number(100)
+        mat = Ray.from_number(1.5)
+        inks = [Wad.from_number(1), Wad.from_number(1), Wad(0), Wad.from_number(3)]
+        arts = [Wad.from_number(150), Wad.from_number(140), Wad(1), Wad(0)]
+
+        expected = [Ray(art) * rate > Ray(ink) * spot * mat for ink, art in zip(inks, arts)]
+        assert expected == [True, False, True, False]
+        assert [is_underwater(ink.value, art.value, rate.value, spot.value, mat.value)
+                for ink, art in zip(inks, arts)] == expected
+
+    def test_prioritize(self):
+        print_out("test_prioritize")
+
+        rate = Ray.from_number(1.05)
+        spot = Ray.from_number(100)
+        mat = Ray.from_number(1.5)
+        dust = skim_value(Wad.from_number(1).value, Wad.from_number(100).value, rate.value, spot.value, mat.value)
+        whale = skim_value(Wad.from_number(10**4).value, Wad.from_number(10**6).value, rate.value, spot.value, mat.value)
+        assert Rad(dust) == Rad(Wad.from_number(100)) * Rad(rate) + Rad(Wad.from_number(1)) * Rad(spot * mat)
+
+        # the most value per unit of gas goes first, and the budget stops the long tail
+        ranked = rank(["dust", "whale", "unestimated"], [dust, whale, whale], [200000, 200000, None], 400000)
+        assert [candidate for candidate, _, _ in ranked] == ["whale", "unestimated", "dust"]
+        assert list(Budget(10**9, max_spend=600000 * 10**9).take("skim", ranked)) == ["whale", "unestimated"]
+        assert list(Budget(10**9, deadline=time.time() - 1).take("skim", ranked)) == []
+
+    def test_scheduler(self):
+        print_out("test_scheduler")
+
+        scheduler = Scheduler()
+        ran = []
+        done = threading.Event()
+
+        # given a task which is replaced before it is due, and one which is cancelled
+        scheduler.schedule("wakeup", time.time() + 60, lambda: ran.append("first"))
+        scheduler.schedule("wakeup", time.time() + 0.2, lambda: ran.append("second") or done.set())
+        scheduler.schedule("cancelled", time.time() + 0.1, lambda: ran.append("cancelled"))
+        scheduler.cancel("cancelled")
+
+        # then only the replacement runs, and the task is pending until it has
+        assert scheduler.is_pending("wakeup")
+        assert not scheduler.is_pending("cancelled")
+        assert done.wait(5)
+        deadline = time.time() + 5
+        while scheduler.is_pending("wakeup") and time.time() < deadline:
+            time.sleep(0.01)
+        assert not scheduler.is_pending("wakeup")
+        time.sleep(0.2)
+        assert ran == ["second"]
+
+    def test_urn_table(self):
+        print_out("test_urn_table")
+
+        eth = Ilk("ETH-A", rate=Ray.from_number(1.05))
+        bat = Ilk("BAT-A", rate=Ray.from_number(1.01))
+        urns = [Urn(Address("0x00000000000000000000000000000000000000aa"), eth, Wad.from_number(10**9), Wad(2**200)),
+                Urn(Address("0x00000000000000000000000000000000000000bb"), bat, Wad(0), Wad(1)),
+                Urn(Address("0x00000000000000000000000000000000000000cc"), Ilk("ETH-A"), Wad(3), Wad(4))]
+
+        table = UrnTable(urns)
+        assert len(table) == 3
+        assert table.ilks == [eth, bat]
+        for view, urn in zip(table, urns):
+            assert isinstance(view, Urn)
+            assert (view.address, view.ink, view.art) == (urn.address, urn.ink, urn.art)
+            assert view.ilk.name == urn.ilk.name
+        # Ilks are interned by name
+        assert table[-1].ilk is eth
+
     def test_check_deployment(self, mcd: DssDeployment, keeper: CageKeeper):
         print_out("test_check_deployment")
         keeper.check_deployment()
 
+    def test_fast_start(self, mcd: DssDeployment, keeper_address: Address):
+        print_out("test_fast_start")
+
+        fast_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --fast-start".split(),
+                                 web3=mcd.web3)
+        fast_keeper.check_deployment()
+
+        # Checking whether the system is live only needs End, so nothing else has been built yet
+        assert fast_keeper.cage_watcher.live()
+        assert fast_keeper.deployment.end.address == mcd.end.address
+        assert fast_keeper.deployment._deployment is None
+
+        assert fast_keeper.dss.vat.address == mcd.vat.address
+
+    def test_cage_watcher(self, mcd: DssDeployment):
+        print_out("test_cage_watcher")
+
+        watcher = CageWatcher(mcd.web3, mcd.end, confirmations=2)
+        assert watcher.live()
+
+        # given a cage log whose first confirming End.live() read fails
+        block = mcd.web3.eth.blockNumber
+        entries = [[{'blockNumber': block}], [], []]
+        watcher.filter = types.SimpleNamespace(get_new_entries=lambda: entries.pop(0))
+        reads = []
+
+        def live():
+            reads.append(len(reads))
+            if len(reads) == 1:
+                raise requests.exceptions.ConnectionError("no response")
+            return len(reads) < 3
+
+        watcher.end = types.SimpleNamespace(live=live)
+        with pytest.raises(requests.exceptions.ConnectionError):
+            watcher.live()
+
+        # then the log is not lost: End.live() is read again on each check until it confirms the cage
+        assert watcher.live()
+        assert not watcher.live()
+        assert watcher.caged
+        assert len(reads) == 3
+
     def test_get_underwater_urns(self, mcd: DssDeployment, keeper: CageKeeper, guy_address: Address, our_address: Address):
         print_out("test_get_underwater_urns")
 
@@ -292,7 +425,7 @@ class TestCageKeeper:
         ilks = keeper.get_ilks()
 
         urns = keeper.get_underwater_urns(ilks)
-        assert type(urns) is list
+        assert type(urns) is UrnTable
         assert all(isinstance(x, Urn) for x in urns)
         assert len(urns) == 1
         assert urns[0].address.address == guy_address.address
@@ -304,6 +437,125 @@ class TestCageKeeper:
 
         pytest.global_urns = urns
 
+    def test_urn_index(self, mcd: DssDeployment, keeper: CageKeeper, keeper_address: Address, tmpdir):
+        print_out("test_urn_index")
+
+        index_file = str(tmpdir.join("urns.db"))
+        indexed_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                         f"--urn-index {index_file}".split(), web3=mcd.web3)
+        ilks = keeper.get_ilks()
+
+        # First run syncs the whole history, second run only the blocks since
+        for _ in range(2):
+            urns = indexed_keeper.get_underwater_urns(ilks)
+            assert [urn.address for urn in urns] == [urn.address for urn in keeper.get_underwater_urns(ilks)]
+
+        for ilk in ilks:
+            assert indexed_keeper.urn_index.last_block(ilk.name) == mcd.web3.eth.blockNumber
+
+        # An index file synced from another Vat is cleared rather than trusted
+        reused = UrnIndex(index_file)
+        reused.bind(Address("0x0000000000000000000000000000000000000001"), int(mcd.web3.eth.chainId))
+        for ilk in ilks:
+            assert reused.last_block(ilk.name) is None
+            assert reused.addresses(ilk.name) == []
+
+    def test_urn_index_fork(self, mcd: DssDeployment, keeper_address: Address, our_address: Address,
+                            other_address: Address, tmpdir):
+        print_out("test_urn_index_fork")
+
+        # given an urn which only ever received collateral through Vat.fork
+        ilk = mcd.collaterals['ETH-C'].ilk
+        assert mcd.vat.urn(ilk, other_address).ink == Wad(0)
+        assert mcd.vat.hope(our_address).transact(from_address=other_address)
+        assert mcd.vat.fork(ilk, our_address, other_address, Wad.from_number(5), Wad(0)).transact(from_address=our_address)
+
+        # then it is indexed along with the urn it was forked from
+        indexed_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                         f"--urn-index {str(tmpdir.join('urns.db'))}".split(), web3=mcd.web3)
+        urns = {urn.address: urn for urn in indexed_keeper.urn_history(ilk).iter_urns()}
+        assert urns[other_address].ink == Wad.from_number(5)
+        assert our_address in urns
+
+    def test_log_scanner(self, mcd: DssDeployment):
+        print_out("test_log_scanner")
+
+        filter_params = {'address': mcd.vat.address.address}
+        to_block = mcd.web3.eth.blockNumber
+        expected = mcd.web3.eth.getLogs({**filter_params, 'fromBlock': 1, 'toBlock': to_block})
+
+        # A small target shrinks the ranges, which are still yielded consecutively and in order
+        scanner = LogScanner(mcd.web3, window=2, target=2, workers=3)
+        next_block, logs = 1, []
+        for start, end, chunk in scanner.scan(filter_params, 1, to_block):
+            assert start == next_block
+            next_block = end + 1
+            logs += chunk
+
+        assert next_block == to_block + 1
+        assert [log['transactionHash'] for log in logs] == [log['transactionHash'] for log in expected]
+
+    def test_log_scanner_split(self, mcd: DssDeployment):
+        print_out("test_log_scanner_split")
+
+        filter_params = {'address': mcd.vat.address.address}
+        to_block = mcd.web3.eth.blockNumber
+        expected = mcd.web3.eth.getLogs({**filter_params, 'fromBlock': 1, 'toBlock': to_block})
+
+        # The first range times out only once later ranges have filled the buffer, and must still be split and retried
+        class SlowFirstRange(LogScanner):
+            def get_logs(self, filter_params: dict, start: int, end: int):
+                if start == 1 and end > 1:
+                    time.sleep(0.5)
+                    raise requests.exceptions.Timeout("timed out")
+                return super().get_logs(filter_params, start, end)
+
+        scanner = SlowFirstRange(mcd.web3, window=2, max_window=2, workers=2)
+        ranges, logs = [], []
+        for start, end, chunk in scanner.scan(filter_params, 1, to_block):
+            ranges.append((start, end))
+            logs += chunk
+
+        assert ranges[0] == (1, 1)
+        assert ranges[-1][1] == to_block
+        assert [log['transactionHash'] for log in logs] == [log['transactionHash'] for log in expected]
+
+    def test_vulcanize_pages(self):
+        print_out("test_vulcanize_pages")
+
+        nodes = [{"urnIdentifier": f"0x{index:040x}", "ink": str(index * 10**18), "art": str(index)}
+                 for index in range(1, 251)]
+        offsets = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                variables = json.loads(self.rfile.read(int(self.headers['Content-Length'])))['variables']
+                offsets.append(variables['offset'])
+                # The second page fails once, and is retried on its own
+                if offsets.count(100) == 1 and variables['offset'] == 100:
+                    self.send_response(502)
+                    self.end_headers()
+                    return
+                page = nodes[variables['offset']:variables['offset'] + variables['first']]
+                body = json.dumps({"data": {"allUrns": {"totalCount": len(nodes), "nodes": page}}}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            provider = PagedVulcanizeUrnHistoryProvider(Ilk("ETH-A"), f"http://127.0.0.1:{server.server_port}",
+                                                        vulcanize_session("key"), page_size=100, workers=2, backoff=0)
+            urns = list(provider.iter_urns())
+        finally:
+            server.shutdown()
+
+        assert sorted(offsets) == [0, 100, 100, 200]
+        assert sorted(urn.address.address.lower() for urn in urns) == [node["urnIdentifier"] for node in nodes]
+        assert all(urn.art == Wad(int(urn.address.address, 16)) for urn in urns)
+
     def test_get_ilks(self, mcd: DssDeployment, keeper: CageKeeper):
         print_out("test_get_ilks")
 
@@ -316,6 +568,16 @@ class TestCageKeeper:
 
         assert all(elem not in empty_deploymentIlks for elem in ilks)
 
+    def test_thaw_state(self, mcd: DssDeployment, keeper: CageKeeper):
+        print_out("test_thaw_state")
+
+        # Read in a single batch, and matching what is read one call at a time before cage
+        state = ThawState.read(keeper.batch, mcd)
+        assert [ilk.name for ilk in state.ilks] == [ilk.name for ilk in keeper.get_ilks()]
+        assert [ilk.name for ilk in state.unflowed] == [ilk.name for ilk in state.ilks]
+        assert state.dai == mcd.vat.dai(mcd.vow.address)
+        assert not state.thawed
+
     def test_active_auctions(self, mcd: DssDeployment, keeper: CageKeeper, our_address: Address, other_address: Address, deployment_address: Address):
         print_out("test_active_auctions")
         print(f"Sin: {mcd.vat.sin(mcd.vow.address)}")
@@ -357,6 +619,282 @@ class TestCageKeeper:
 
         pytest.global_auctions = auctions
 
+    def test_batched_bids(self, mcd: DssDeployment, keeper: CageKeeper):
+        print_out("test_batched_bids")
+
+        for auction in [mcd.flapper, mcd.flopper, mcd.collaterals['ETH-A'].flipper]:
+            ids = range(1, auction.kicks()+1)
+            batched = list(keeper.batch.bids(auction, ids))
+            assert len(batched) == len(ids)
+            for bid in batched:
+                assert vars(bid) == vars(auction._bids(bid.id))
+
+    def test_auction_index(self, mcd: DssDeployment, keeper_address: Address, tmpdir):
+        print_out("test_auction_index")
+
+        index_file = str(tmpdir.join("auctions.db"))
+        indexed_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                         f"--auction-index {index_file}".split(), web3=mcd.web3)
+
+        # First run syncs the whole history, second run only the blocks since
+        for _ in range(2):
+            auctions = indexed_keeper.all_active_auctions()
+            assert [bid.id for bid in auctions["flaps"]] == [bid.id for bid in pytest.global_auctions["flaps"]]
+            assert [bid.id for bid in auctions["flops"]] == [bid.id for bid in pytest.global_auctions["flops"]]
+            for ilk, bids in pytest.global_auctions["flips"].items():
+                assert [bid.id for bid in auctions["flips"][ilk]] == [bid.id for bid in bids]
+
+        # Only auctions still open are indexed as such
+        flapper = mcd.flapper.address.address
+        assert indexed_keeper.auction_index.open_ids(flapper) == [bid.id for bid in auctions["flaps"]]
+        assert indexed_keeper.auction_index.last_block(flapper) == mcd.web3.eth.blockNumber
+
+    def test_snapshot(self, mcd: DssDeployment, keeper: CageKeeper, keeper_address: Address, tmpdir):
+        print_out("test_snapshot")
+
+        filename = str(tmpdir.join("state.snap"))
+        keeper.export_snapshot(filename)
+        block = mcd.web3.eth.blockNumber
+
+        snapshot_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                          f"--snapshot {filename}".split(), web3=mcd.web3)
+        assert snapshot_keeper.snapshot.block == block
+        ilks = keeper.get_ilks()
+
+        # Urns and auctions are taken from the snapshot, and only blocks since are synced
+        urns = snapshot_keeper.get_underwater_urns(ilks)
+        assert sorted(urn.address.address for urn in urns) == \
+               sorted(urn.address.address for urn in keeper.get_underwater_urns(ilks))
+        for ilk in ilks:
+            assert snapshot_keeper.snapshot_index.last_block(ilk.name) == mcd.web3.eth.blockNumber
+
+        auctions = snapshot_keeper.all_active_auctions()
+        assert [bid.id for bid in auctions["flaps"]] == [bid.id for bid in pytest.global_auctions["flaps"]]
+        assert [bid.id for bid in auctions["flops"]] == [bid.id for bid in pytest.global_auctions["flops"]]
+
+        # A snapshot of another deployment is refused
+        snapshot = open(filename, "rb").read()
+        with open(filename, "wb") as file:
+            file.write(snapshot[:18] + bytes(20) + snapshot[38:])
+        with pytest.raises(ValueError):
+            CageKeeper(args=f"--eth-from {keeper_address} --network testnet --snapshot {filename}".split(),
+                       web3=mcd.web3)
+
+    def test_rpc_pool(self, mcd: DssDeployment, keeper: CageKeeper):
+        print_out("test_rpc_pool")
+
+        # given a pool whose first endpoint is down
+        pool = RpcPool([HTTPProvider("http://127.0.0.1:1"), HTTPProvider("http://0.0.0.0:8545")], backoff=60)
+        web3 = Web3(pool)
+
+        # then reads, batches and transaction state are served by the healthy endpoint
+        assert web3.eth.blockNumber == mcd.web3.eth.blockNumber
+        nonce = mcd.web3.eth.getTransactionCount(keeper.our_address.address)
+        assert web3.eth.getTransactionCount(keeper.our_address.address) == nonce
+        ids = range(1, mcd.flapper.kicks()+1)
+        batched = list(BatchCaller(web3).bids(mcd.flapper, ids))
+        assert [vars(bid) for bid in batched] == [vars(mcd.flapper._bids(id)) for id in ids]
+
+        # and the failed endpoint has been ejected rather than retried on every request
+        assert pool.endpoints[0].failures == 1
+        assert pool.endpoints[1].failures == 0
+
+        # given a node five blocks behind the testchain
+        head = mcd.web3.eth.blockNumber
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                body = json.dumps({"jsonrpc": "2.0", "id": request['id'], "result": hex(head - 5)}).encode()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            lagging = RpcPool([HTTPProvider("http://0.0.0.0:8545"),
+                               HTTPProvider(f"http://127.0.0.1:{server.server_port}")])
+
+            # then logs are only scanned up to the blocks both nodes have seen
+            assert LogScanner(Web3(lagging)).head() == head - 5
+        finally:
+            server.shutdown()
+
+    def test_check_cage_retries(self, keeper: CageKeeper, monkeypatch):
+        print_out("test_check_cage_retries")
+
+        # given a node which is briefly unavailable
+        attempts = []
+
+        def check_cage_once():
+            attempts.append(len(attempts))
+            if len(attempts) < 3:
+                raise ValueError({'code': -32000, 'message': 'No response or no available upstream'})
+
+        monkeypatch.setattr(keeper, "check_cage_once", check_cage_once)
+        monkeypatch.setattr("src.cage_keeper.time.sleep", lambda seconds: None)
+
+        # then the check is retried rather than counted as an error
+        keeper.check_cage()
+        assert len(attempts) == 3
+
+        # and other errors are raised straight away
+        monkeypatch.setattr(keeper, "check_cage_once", lambda: attempts.append(0) or 1 / 0)
+        with pytest.raises(ZeroDivisionError):
+            keeper.check_cage()
+        assert len(attempts) == 4
+
+    def test_sender_pool(self, mcd: DssDeployment, keeper: CageKeeper, our_address: Address, other_address: Address):
+        print_out("test_sender_pool")
+
+        assert key_addresses(["key_file=tests/config/keys/UnlimitedChain/key2.json,pass_file=/dev/null"]) == \
+               [Address("0x50FF810797f75f6bfbf2227442e0c961a8562F4C")]
+
+        # given two funded accounts
+        senders = SenderPool(mcd.web3, keeper.batch, our_address, [other_address, our_address], Wad.from_number(0.1))
+        senders.refresh()
+        assert senders.accounts == [our_address, other_address]
+        assert not senders.stale()
+
+        # then transactions in flight are spread across both
+        first, second = senders.acquire(), senders.acquire()
+        assert {first, second} == {our_address, other_address}
+        senders.release(first)
+        senders.release(second)
+
+        # and accounts which cannot pay for gas are not used, falling back to the primary
+        broke = SenderPool(mcd.web3, keeper.batch, our_address, [other_address], Wad.from_number(10**12))
+        broke.refresh()
+        assert broke.funded == []
+        assert broke.acquire() == our_address
+
+    def test_max_pending_txs(self, mcd: DssDeployment, keeper_address: Address):
+        print_out("test_max_pending_txs")
+
+        pipelined_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet "
+                                           f"--max-pending-txs 3".split(), web3=mcd.web3)
+        ilk = mcd.collaterals['ETH-A'].ilk
+        drips = ((mcd.jug.drip(ilk), index) for index in range(8))
+
+        # given up to three transactions from one account awaiting receipts at once
+        in_flight, peak, results = [0], [0], {}
+
+        def submitted(index):
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+
+        def mined(index, result):
+            in_flight[0] -= 1
+            results[index] = result
+
+        # then every one is mined, without more than three ever being in flight
+        assert pipelined_keeper.pipeline.execute_stream(drips, mined, submitted) == 8
+        assert sorted(results.keys()) == list(range(8))
+        assert all(result is not None and not isinstance(result, Exception) for result in results.values())
+        assert 1 <= peak[0] <= 3
+
+    def test_fan_out(self, mcd: DssDeployment, keeper_address: Address, our_address: Address, other_address: Address):
+        print_out("test_fan_out")
+
+        # given a keeper fanning out across three funded accounts
+        fan_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --fan-out".split(),
+                                web3=mcd.web3)
+        fan_keeper.senders = SenderPool(mcd.web3, fan_keeper.batch, keeper_address, [our_address, other_address],
+                                        Wad.from_number(0.1))
+
+        # then permissionless drips are all mined, spread across the accounts
+        ilk = mcd.collaterals['ETH-A'].ilk
+        drips = [(mcd.jug.drip(ilk), f"dripping ilk {ilk.name}", f"drip:{ilk.name}:{index}") for index in range(6)]
+        assert fan_keeper.transact_stream(drips, fan_out=True) == 6
+        for _, _, key in drips:
+            assert fan_keeper.journal.is_confirmed(key)
+        assert sum(fan_keeper.senders.sent.values()) == 6
+        assert len([account for account, sent in fan_keeper.senders.sent.items() if sent > 0]) > 1
+        assert all(in_flight == 0 for in_flight in fan_keeper.senders.in_flight.values())
+
+    def test_bundler(self, mcd: DssDeployment, keeper_address: Address):
+        print_out("test_bundler")
+
+        bundled_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --bundle "
+                                         f"--no-preflight".split(), web3=mcd.web3)
+        bundled_keeper.check_deployment()
+        assert bundled_keeper.bundler.tx_manager.owner() == keeper_address
+
+        # Drips are permissionless and succeed, skimming before cage reverts and takes its bundle down with it
+        ilks = [collateral.ilk for collateral in mcd.collaterals.values()][:2]
+        drips = [(mcd.jug.drip(ilk), f"dripping ilk {ilk.name}", f"drip:{ilk.name}") for ilk in ilks]
+        early_skim = (mcd.end.skim(ilks[0], keeper_address), "skimming before cage", "skim:early")
+        bundled_keeper.transact_stream(drips + [early_skim], fan_out=True)
+
+        # so the bundle is split until the drips are mined without it
+        for ilk in ilks:
+            assert bundled_keeper.journal.is_confirmed(f"drip:{ilk.name}")
+        assert not bundled_keeper.journal.is_confirmed("skim:early")
+
+    def test_warm_standby(self, mcd: DssDeployment, keeper: CageKeeper, keeper_address: Address):
+        print_out("test_warm_standby")
+
+        warm_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                      f"--warm-standby".split(), web3=mcd.web3)
+        warm_keeper.refresh_standby()
+        # Refreshes run every block, so they are not counted as the ilks and auctions phases of the cage
+        assert "ilks" not in warm_keeper.metrics.phases
+        assert "auctions" not in warm_keeper.metrics.phases
+        for ilk in warm_keeper.get_ilks():
+            assert warm_keeper.urn_index.last_block(ilk.name) == mcd.web3.eth.blockNumber
+
+            # Urns are read from Vat.urns in batches, matching what Vat.urn returns for each
+            for urn in warm_keeper.urn_history(ilk).iter_urns():
+                expected_urn = mcd.vat.urn(ilk, urn.address)
+                assert (urn.ink, urn.art) == (expected_urn.ink, expected_urn.art)
+
+        # Refreshing again only re-reads auctions which are still active
+        warm_keeper.refresh_standby()
+        auctions = warm_keeper.all_active_auctions()
+        expected = pytest.global_auctions
+        for ilk in expected["flips"].keys():
+            assert [bid.id for bid in auctions["flips"][ilk]] == [bid.id for bid in expected["flips"][ilk]]
+        assert [bid.id for bid in auctions["flaps"]] == [bid.id for bid in expected["flaps"]]
+        assert [bid.id for bid in auctions["flops"]] == [bid.id for bid in expected["flops"]]
+
+    def test_plan_only(self, mcd: DssDeployment, keeper: CageKeeper, tmpdir):
+        print_out("test_plan_only")
+
+        block = mcd.web3.eth.blockNumber
+        filename = str(tmpdir.join("plan.json"))
+        keeper.write_plan(filename)
+        with open(filename, "r") as file:
+            plan = json.load(file)
+
+        # Planning must not send anything
+        assert mcd.web3.eth.blockNumber == block
+
+        stages = {stage["name"]: stage for stage in plan["stages"]}
+        assert stages["yank"]["count"] == 2
+        assert stages["cage"]["count"] == len(keeper.get_ilks())
+        assert stages["skip"]["count"] == sum(len(bids) for bids in pytest.global_auctions["flips"].values())
+        assert stages["thaw"]["count"] == 1
+        assert plan["totalGas"] == sum(stage["gas"] for stage in plan["stages"])
+        assert plan["projectedCostEth"] > 0
+
+    def test_snapshot_skims(self, mcd: DssDeployment, keeper: CageKeeper, keeper_address: Address, tmpdir):
+        print_out("test_snapshot_skims")
+
+        filename = str(tmpdir.join("state.snap"))
+        keeper.export_snapshot(filename)
+        snapshot_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                          f"--snapshot {filename}".split(), web3=mcd.web3)
+        ilks = keeper.get_ilks()
+
+        # Urns left unchanged since the snapshot are skimmed straight from it, though they are read-only views
+        skims = list(snapshot_keeper.skims(ilks))
+        for ilk in ilks:
+            assert snapshot_keeper.snapshot_index.addresses(ilk.name) == []
+        assert sorted(key for _, _, key in skims) == \
+               sorted(f"skim:{urn.ilk.name}:{urn.address.address}" for urn in keeper.get_underwater_urns(ilks))
+
     def test_check_cage(self, mcd: DssDeployment, keeper: CageKeeper, our_address: Address, other_address: Address):
         print_out("test_check_cage")
         keeper.check_cage()
@@ -369,6 +907,8 @@ class TestCageKeeper:
             time_travel_by(mcd.web3, 1)
             keeper.check_cage()
         assert keeper.confirmations == 12
+        assert keeper.cage_watcher.caged
+        assert keeper.cage_watcher.when_and_wait() == (mcd.end.when(), mcd.end.wait())
 
         keeper.check_cage() # Facilitate processing period
         assert keeper.cageFacilitated == True
@@ -398,10 +938,26 @@ class TestCageKeeper:
             # Check if flow(ilk) called on all ilks
             assert mcd.end.fix(ilk) > Ray(0)
 
+            # Both were journaled, so a restarted keeper would not send them again
+            assert keeper.journal.is_confirmed(f"cage:{ilk.name}")
+            assert keeper.journal.is_confirmed(f"flow:{ilk.name}")
+
+            # Caging an ilk twice reverts, so pre-flight simulation drops it
+            assert keeper.batch.simulate([mcd.end.cage(ilk)], keeper.our_address) == [False]
+
+        # and journals it as skipped, so it does not keep the processing period from being finished
+        ilk = ilks[0]
+        assert keeper.transact_stream([(mcd.end.cage(ilk), f"caging ilk {ilk.name} again", "cage:again")]) == 0
+        assert keeper.journal.status("cage:again") == ActionJournal.SKIPPED
+        assert keeper.journal.unfinished("cage:") == []
+
         # All underwater urns present before ES have been skimmed
         for i in urns:
             urn = mcd.vat.urn(i.ilk, i.address)
             assert urn.art == Wad(0)
+            assert keeper.journal.is_confirmed(f"skim:{i.ilk.name}:{i.address.address}")
+        assert keeper.journal.unconfirmed("skim:") == []
+        assert keeper.journal.is_confirmed("processing-period")
 
         # All auctions active before cage have been yanked
         for ilk in auctions["flips"].keys():
@@ -416,3 +972,35 @@ class TestCageKeeper:
 
         # Cage has been thawed (thaw() called)
         assert mcd.end.debt() != Rad(0)
+
+    def test_metrics(self, mcd: DssDeployment, keeper_address: Address):
+        print_out("test_metrics")
+
+        # given a keeper serving metrics, which has read ilks and auctions
+        metrics_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet --vat-deployment-block {1} "
+                                         f"--metrics-port 0".split(), web3=mcd.web3)
+        metrics_keeper.get_ilks()
+        metrics_keeper.all_active_auctions()
+
+        assert metrics_keeper.metrics.methods["eth_call"].count > 0
+        assert metrics_keeper.metrics.methods["eth_call"].bytes_received > 0
+        assert metrics_keeper.metrics.methods["batch"].count > 0
+        for phase in ["ilks", "auctions"]:
+            assert metrics_keeper.metrics.phases[phase][0] > 0
+
+        # then everything is exposed at the metrics endpoint
+        metrics_keeper.metrics.serve("127.0.0.1", 0)
+        try:
+            body = requests.get(f"http://127.0.0.1:{metrics_keeper.metrics.server.server_address[1]}/metrics").text
+        finally:
+            metrics_keeper.metrics.stop()
+
+        assert 'cage_keeper_rpc_requests_total{method="eth_call"}' in body
+        assert 'cage_keeper_rpc_latency_seconds_bucket{method="eth_call",le="+Inf"}' in body
+        assert 'cage_keeper_phase_seconds_total{phase="ilks"}' in body
+
+        # and without a metrics port, calls are counted but their bytes are not
+        plain_keeper = CageKeeper(args=f"--eth-from {keeper_address} --network testnet".split(), web3=mcd.web3)
+        plain_keeper.get_ilks()
+        assert plain_keeper.metrics.methods["eth_call"].count > 0
+        assert plain_keeper.metrics.methods["eth_call"].bytes_received == 0